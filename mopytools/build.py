@@ -38,13 +38,17 @@ import sys
 
 from mopytools.util import (run, envname, update_cmd, step,
                             get_project_name, is_meta_project,
-                            has_changes, is_git)
+                            has_changes, forget_changes, is_git,
+                            get_revision)
 
 
 @step('Updating the repo')
 def updating_repo(name, channel, specific_tags, force=False, timeout=60,
-                  verbose=False):
-    if not force and has_changes(timeout, verbose) and channel != 'dev':
+                  verbose=False, dirty=None):
+    if dirty is None:
+        dirty = has_changes(timeout, verbose)
+
+    if not force and dirty and channel != 'dev':
         print('The code was changed locally, aborting!')
         print('You can use --force but all uncommited '
               'changes will be discarded.')
@@ -54,6 +58,7 @@ def updating_repo(name, channel, specific_tags, force=False, timeout=60,
         run('git submodule update')
 
     run(update_cmd(name, channel, specific_tags, force), timeout, verbose)
+    forget_changes(os.getcwd())
 
 
 @step('Checking provided tags')
@@ -112,3 +117,67 @@ def get_environ_info(deps):
 
     specific_tags = provided == len(projects) and missing == 0
     return name, specific_tags
+
+
+class BuildSession(object):
+    """What a buildapp or buildrpms invocation learns about its repos.
+
+    The session is created once per invocation and passed along, so the
+    environ is checked, the repo updated and each checkout looked at for
+    local changes and for its revision only once, even when buildrpms runs
+    buildapp first.
+
+    The tags are not kept here: get_tag_index() already reads them once
+    per repository, until its refs change.
+    """
+    def __init__(self, deps, channel, force=False, timeout=300,
+                 verbose=False):
+        self.deps = deps
+        self.channel = channel
+        self.force = force
+        self.timeout = timeout
+        self.verbose = verbose
+        # checkout location -> has local changes
+        self.dirty = {}
+        # checkout location -> checked out revision
+        self.revisions = {}
+        self._environ = None
+        self._updated = False
+
+    def get_environ_info(self):
+        if self._environ is None:
+            self._environ = get_environ_info(self.deps)
+        return self._environ
+
+    @property
+    def name(self):
+        return self.get_environ_info()[0]
+
+    @property
+    def specific_tags(self):
+        return self.get_environ_info()[1]
+
+    def has_changes(self):
+        """Tells if the checkout in the current dir has local changes."""
+        location = os.getcwd()
+        if location not in self.dirty:
+            self.dirty[location] = has_changes(self.timeout, self.verbose)
+        return self.dirty[location]
+
+    def get_revision(self):
+        """Returns the revision checked out in the current dir."""
+        location = os.getcwd()
+        if location not in self.revisions:
+            self.revisions[location] = get_revision()
+        return self.revisions[location]
+
+    def update_repo(self):
+        """Updates the app repo to the channel tag, once."""
+        if self._updated:
+            return
+        updating_repo(self.name, self.channel, self.specific_tags,
+                      self.force, self.timeout, self.verbose,
+                      self.has_changes())
+        self.dirty.pop(os.getcwd(), None)
+        self.revisions.pop(os.getcwd(), None)
+        self._updated = True
@@ -35,12 +35,23 @@
 # ***** END LICENSE BLOCK *****
 import os
 import sys
+import shutil
+import hashlib
+import tempfile
 
 from mopytools.util import (timeout, get_options, step, get_channel,
-                            update_cmd, is_meta_project, PYTHON, run, PIP,
-                            REPO_ROOT, has_changes, is_git, get_non_pinned,
-                            DependencyError)
-from mopytools.build import get_environ_info, updating_repo
+                            update_cmd, checkout_cmd, is_meta_project,
+                            PYTHON, run, PIP,
+                            REPO_ROOT, has_changes, forget_changes, is_git,
+                            get_non_pinned, DependencyError, run_jobs,
+                            develop, envname,
+                            get_tag_index, is_checked_out,
+                            has_new_remote_tags, get_remote_tag_index,
+                            install_requirements, get_revision,
+                            is_developed, requirements_to_install)
+from mopytools.build import BuildSession
+from mopytools.plan import (Plan, record_duration, load_durations,
+                            save_durations, DURATIONS_FILE)
 
 
 @timeout(4.0)
@@ -60,23 +71,50 @@ def main():
     channel = get_channel(options)
     print("The current channel is %s." % channel)
 
-    _buildapp(channel, deps, options.force, options.timeout, options.verbose,
-              options.index, options.extras, options.download_cache)
+    session = BuildSession(deps, channel, options.force, options.timeout,
+                           options.verbose)
+    if options.plan:
+        plan = Plan(load_durations())
+        plan_buildapp(session, options, plan)
+        plan.display()
+        return
+
+    durations = os.path.abspath(DURATIONS_FILE)
+    try:
+        buildapp_session(session, options)
+    finally:
+        save_durations(durations)
+
+
+def buildapp_session(session, options):
+    """Builds the app of a session, with the parsed command-line options."""
+    _buildapp(session.channel, session.deps, options.force, options.timeout,
+              options.verbose, options.index, options.extras,
+              options.download_cache, options.jobs, options.mirror_dir,
+              options.shallow, options.wheelhouse, session,
+              options.reinstall)
 
 
 @step('Building the app')
-def _buildapp(channel, deps, force, timeout, verbose, index, extras, cache):
+def _buildapp(channel, deps, force, timeout, verbose, index, extras, cache,
+              jobs=1, mirror_dir=None, shallow=False, wheelhouse=None,
+              session=None, reinstall=False):
+    if session is None:
+        session = BuildSession(deps, channel, force, timeout, verbose)
+
     # check the environ
-    name, specific_tags = get_environ_info(deps)
+    name, specific_tags = session.get_environ_info()
 
     # updating the repo
-    updating_repo(name, channel, specific_tags, force, timeout, verbose)
+    session.update_repo()
 
     # building internal deps first
-    build_deps(deps, channel, specific_tags, timeout, verbose)
+    build_deps(deps, channel, specific_tags, timeout, verbose, jobs,
+               reinstall, mirror_dir, shallow, session)
 
     # building the external deps now
-    build_external_deps(channel, index, extras, timeout, verbose, cache)
+    build_external_deps(channel, index, extras, timeout, verbose, cache,
+                        reinstall, wheelhouse)
 
     # if the current repo is a meta-repo, running tip on it
     if is_meta_project():
@@ -84,55 +122,174 @@ def _buildapp(channel, deps, force, timeout, verbose, index, extras, cache):
         channel = "dev"
 
     # build the app now
-    build_core_app(timeout, verbose)
+    build_core_app(timeout, verbose, reinstall)
 
 
 @step('Now building the app itself')
-def build_core_app(timeout=300, verbose=False):
-    run('%s setup.py develop' % PYTHON, timeout, verbose)
+def build_core_app(timeout=300, verbose=False, reinstall=False):
+    develop(PYTHON, timeout, verbose, reinstall)
 
 
 def _is_git_repo(url):
     # lame but enough for now
-    return url.startswith('git://') or 'github.com' in url
+    if url.startswith('git://') or 'github.com' in url:
+        return True
+    # local repositories
+    return os.path.isdir(os.path.join(url, '.git'))
 
 
 _REPO_SCHEMES = ('git', 'https', 'ssh')
 
 
-@step("Getting %(dep)s")
-def build_dep(dep=None, deps_dir=None, channel='prod', specific_tags=False,
-              timeout=300, verbose=False):
-
+def _repo_url(dep):
     # using REPO_ROOT if the provided dep is not an URL
-    is_url = False
     for scheme in _REPO_SCHEMES:
         if dep.startswith(scheme):
-            is_url = True
-            break
-
-    if not is_url:
-        repo = REPO_ROOT + dep
+            return dep
+    return REPO_ROOT + dep
+
+
+def _is_up_to_date(dep, repo, channel='prod', specific_tags=False,
+                   remote=True):
+    """Tells if the dependency in the current dir is already checked out at
+    its target tag, looking at the local refs first.
+
+    Branches can move at any time, so the dev channel is never up-to-date.
+    For the other channels, the remote git tags are listed to make sure the
+    latest tag is known locally, unless remote is False.
+    """
+    if specific_tags:
+        tag = os.environ.get(envname(dep))
+    elif channel == 'dev' or not is_git():
+        return False
+    elif remote and has_new_remote_tags(repo):
+        return False
     else:
-        repo = dep
+        tag = get_tag_index().get_channel_tag(channel)
+
+    return tag is not None and is_checked_out(tag)
+
+
+def _target_tag(dep, repo, channel='prod', specific_tags=False):
+    """Returns the tag or branch to check out, asking the remote."""
+    if specific_tags:
+        return os.environ.get(envname(dep))
+    if channel == 'dev':
+        return 'master'
+    return get_remote_tag_index(repo).get_channel_tag(channel)
+
+
+def update_mirror(repo, mirror_dir, timeout=300, verbose=False):
+    """Creates or updates the bare mirror of repo in mirror_dir.
+
+    Returns the mirror location.
+    """
+    name = '%s-%s' % (os.path.basename(repo.rstrip('/')),
+                      hashlib.sha1(repo).hexdigest()[:8])
+    mirror = os.path.join(mirror_dir, name)
+    git = _is_git_repo(repo)
 
+    # the workspaces borrow the objects of the mirror: they must never be
+    # pruned, even when the branches using them are gone
+    if os.path.exists(mirror):
+        if git:
+            run('git --git-dir=%s -c gc.auto=0 fetch' % mirror, timeout,
+                verbose)
+        else:
+            run('hg pull -R %s' % mirror, timeout, verbose)
+        return mirror
+
+    if not os.path.exists(mirror_dir):
+        os.makedirs(mirror_dir)
+
+    # cloning aside, so concurrent builds never see a partial mirror
+    tmp = tempfile.mkdtemp(dir=mirror_dir, prefix='.tmp-')
+    try:
+        if git:
+            run('git clone -q --mirror -c gc.auto=0 -c gc.pruneExpire=never '
+                '%s %s/mirror' % (repo, tmp), timeout, verbose)
+        else:
+            run('hg clone -U %s %s/mirror' % (repo, tmp), timeout, verbose)
+        try:
+            os.rename(os.path.join(tmp, 'mirror'), mirror)
+        except OSError:
+            # another build created it in the meantime
+            pass
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return mirror
+
+
+def checkout_dep(dep, deps_dir, channel='prod', specific_tags=False,
+                 timeout=300, verbose=False, mirror_dir=None, shallow=False):
+    """Clones or updates a dependency.
+
+    Returns its location, whether it has local changes and its revision.
+
+    With a mirror_dir, the repository is first fetched in a bare mirror
+    shared by all workspaces, then cloned from it using git alternates, or
+    shared with hg. When shallow is True, only the target tag of git
+    repositories is fetched.
+    """
+    repo = _repo_url(dep)
     target = os.path.join(deps_dir, os.path.basename(dep))
+    up_to_date = False
+    tag = None
+    if os.path.exists(target):
+        git = os.path.isdir(os.path.join(target, '.git'))
+    else:
+        # let's try to detect the repo kind with a few heuristics
+        git = _is_git_repo(repo)
+    # only git repositories are fetched shallowly
+    shallow = shallow and git
+    if shallow:
+        tag = _target_tag(dep, repo, channel, specific_tags)
+        if tag is None:
+            print('No tag to fetch for %s, fetching everything.' % dep)
+            shallow = False
     if os.path.exists(target):
         os.chdir(target)
-        if is_git():
-            run('git fetch')
+        if _is_up_to_date(dep, repo, channel, specific_tags):
+            print('Already at the right revision.')
+            up_to_date = True
         else:
-            run('hg pull')
+            if mirror_dir is not None:
+                update_mirror(repo, mirror_dir, timeout, verbose)
+            if is_git() and shallow:
+                run('git fetch --depth 1 origin "+%s:%s"'
+                    % (_refspec(tag), _local_ref(tag)))
+                if tag == 'master':
+                    # git refuses to fetch into the checked out branch
+                    run('git checkout -B master %s' % _local_ref(tag))
+            elif is_git():
+                run('git fetch')
+            else:
+                run('hg pull')
     else:
-        # let's try to detect the repo kind with a few heuristics
-        if _is_git_repo(repo):
+        source = repo
+        if mirror_dir is not None:
+            source = update_mirror(repo, mirror_dir, timeout, verbose)
+
+        if git and shallow:
+            if mirror_dir is not None:
+                # --depth is ignored for local paths
+                source = 'file://' + source
+            run('git clone --depth 1 --branch "%s" %s %s'
+                % (tag, source, target))
+        elif git and mirror_dir is not None:
+            run('git clone --shared %s %s' % (source, target))
+        elif git:
             run('git clone %s %s' % (repo, target))
+        elif mirror_dir is not None:
+            run('hg --config extensions.share= share -U %s %s'
+                % (source, target))
         else:
             run('hg clone %s %s' % (repo, target))
 
         os.chdir(target)
 
-    if has_changes(timeout, verbose):
+    dirty = has_changes(timeout, verbose)
+    if dirty:
         if channel != 'dev':
             print('The code was changed, aborting !')
             print('Use the dev channel if you change locally the code')
@@ -140,14 +297,94 @@ def build_dep(dep=None, deps_dir=None, channel='prod', specific_tags=False,
         else:
             print('Warning: the code was changed.')
 
-    cmd = update_cmd(dep, channel, specific_tags)
-    run(cmd, timeout, verbose)
-    run('%s setup.py develop' % PYTHON, timeout, verbose)
+    if not up_to_date:
+        cmd = update_cmd(dep, channel, specific_tags)
+        run(cmd, timeout, verbose)
+        forget_changes(target)
+    return target, dirty, get_revision()
+
+
+def _refspec(name):
+    if name == 'master':
+        return 'refs/heads/master'
+    return 'refs/tags/' + name
+
+
+def _local_ref(name):
+    if name == 'master':
+        return 'refs/remotes/origin/master'
+    return 'refs/tags/' + name
+
+
+@step("Getting %(dep)s")
+def build_dep(dep=None, deps_dir=None, channel='prod', specific_tags=False,
+              timeout=300, verbose=False, reinstall=False, mirror_dir=None,
+              shallow=False, session=None):
+    result = checkout_dep(dep, deps_dir, channel, specific_tags, timeout,
+                          verbose, mirror_dir, shallow)
+    if session is not None:
+        _record(session, dep, result)
+    develop(PYTHON, timeout, verbose, reinstall)
+
+
+def _record(session, dep, result):
+    target, dirty, revision = result
+    session.dirty[target] = dirty
+    session.revisions[target] = revision
+
+
+@step("Getting all dependencies, %(jobs)d at a time")
+def checkout_deps(deps=None, deps_dir=None, channel='prod',
+                  specific_tags=False, timeout=300, verbose=False, jobs=1,
+                  mirror_dir=None, shallow=False, session=None):
+    calls = [((dep, deps_dir, channel, specific_tags, timeout, verbose,
+               mirror_dir, shallow), {}) for dep in deps]
+    aborted = False
+    failed = 0
+    for index, code, result, output, duration in run_jobs(checkout_dep,
+                                                           calls, jobs):
+        if code != 0:
+            status = 'failed with code %s' % code
+        elif result is None:
+            # the dep exited early, e.g. on local changes, like
+            # checkout_dep does in the serial path
+            status = 'aborted'
+        else:
+            status = 'ok'
+        print('\n--- %s (%.1fs): %s' % (deps[index], duration, status))
+        record_duration('Checking out %s' % deps[index], duration)
+        output = output.strip()
+        if output:
+            print(output)
+        if code != 0 or result is None:
+            aborted, failed = True, code
+            break
+        if session is not None:
+            _record(session, deps[index], result)
+
+    if aborted:
+        sys.exit(failed)
+
+
+@step("Installing %(dep)s")
+def develop_dep(dep=None, deps_dir=None, timeout=300, verbose=False,
+                reinstall=False):
+    os.chdir(os.path.join(deps_dir, os.path.basename(dep)))
+    develop(PYTHON, timeout, verbose, reinstall)
 
 
 @step('Building Services dependencies')
-def build_deps(deps, channel, specific_tags, timeout=300, verbose=False):
-    """Will make sure dependencies are up-to-date"""
+def build_deps(deps, channel, specific_tags, timeout=300, verbose=False,
+               jobs=1, reinstall=False, mirror_dir=None, shallow=False,
+               session=None):
+    """Will make sure dependencies are up-to-date.
+
+    When jobs is greater than 1, the dependencies are cloned or updated
+    in parallel, then installed one after the other in the given order.
+
+    mirror_dir and shallow are passed to checkout_dep. The state of each
+    checkout is recorded in the session, if any.
+    """
     location = os.getcwd()
     # do we want the latest tags ?
     try:
@@ -155,17 +392,28 @@ def build_deps(deps, channel, specific_tags, timeout=300, verbose=False):
         if not os.path.exists(deps_dir):
             os.mkdir(deps_dir)
 
-        for dep in deps:
-            build_dep(dep=dep, deps_dir=deps_dir, channel=channel,
-                      specific_tags=specific_tags, timeout=timeout,
-                      verbose=verbose)
+        if jobs > 1 and len(deps) > 1:
+            checkout_deps(deps=deps, deps_dir=deps_dir, channel=channel,
+                          specific_tags=specific_tags, timeout=timeout,
+                          verbose=verbose, jobs=jobs, mirror_dir=mirror_dir,
+                          shallow=shallow, session=session)
+            for dep in deps:
+                develop_dep(dep=dep, deps_dir=deps_dir, timeout=timeout,
+                            verbose=verbose, reinstall=reinstall)
+        else:
+            for dep in deps:
+                build_dep(dep=dep, deps_dir=deps_dir, channel=channel,
+                          specific_tags=specific_tags, timeout=timeout,
+                          verbose=verbose, reinstall=reinstall,
+                          mirror_dir=mirror_dir, shallow=shallow,
+                          session=session)
     finally:
         os.chdir(location)
 
 
 @step('Building External dependencies')
 def build_external_deps(channel, index, extras, timeout=300, verbose=False,
-                        cache=None):
+                        cache=None, reinstall=False, wheelhouse=None):
     # looking for a req file
     reqname = '%s-reqs.txt' % channel
     if not os.path.exists(reqname):
@@ -185,12 +433,109 @@ def build_external_deps(channel, index, extras, timeout=300, verbose=False,
             inc += 1
         os.rename('build', root + str(inc))
 
-    pip = '%s install -i %s -U -r %s'
-    args = (PIP, index, reqname)
-    if cache is not None:
-        pip += ' --download-cache %s'
-        args += (cache,)
-    if extras is not None:
-        pip += ' --extra-index-url %s'
-        args += (extras,)
-    run(pip % args, timeout, verbose)
+    install_requirements(reqname, index, extras, timeout, verbose, cache,
+                         PYTHON, PIP, reinstall, wheelhouse)
+
+
+def _plan_checkout(dep, deps_dir, channel, specific_tags):
+    """Returns the commands that would get dep, and why they would be
+    skipped, if they would.
+
+    The channel tag of a git dep that is not cloned yet is looked up on
+    the remote. Mercurial has no such lookup: only the clone is listed.
+    """
+    repo = _repo_url(dep)
+    target = os.path.join(deps_dir, os.path.basename(dep))
+    if not os.path.exists(target):
+        git = _is_git_repo(repo)
+        if git:
+            commands = ['git clone %s %s' % (repo, target)]
+        else:
+            commands = ['hg clone %s %s' % (repo, target)]
+        if specific_tags:
+            tag = os.environ.get(envname(dep))
+        elif channel == 'dev':
+            tag = git and 'master' or 'default'
+        elif git:
+            tag = get_remote_tag_index(repo).get_channel_tag(channel)
+        else:
+            return commands, None
+        commands.append(checkout_cmd(tag, git, channel))
+        return commands, None
+
+    os.chdir(target)
+    # the remote is not asked for new tags
+    if _is_up_to_date(dep, repo, channel, specific_tags, remote=False):
+        return [], 'already at the right revision'
+    fetch = is_git() and 'git fetch' or 'hg pull'
+    return [fetch, update_cmd(dep, channel, specific_tags)], None
+
+
+def _plan_develop(target, reinstall=False, moved=True):
+    if os.path.exists(target):
+        os.chdir(target)
+        if not reinstall and not moved and is_developed(PYTHON):
+            return [], 'nothing changed since the last develop'
+    return ['%s setup.py develop' % PYTHON], None
+
+
+def plan_buildapp(session, options, plan):
+    """Adds the steps buildapp would run to plan.
+
+    Only the local repositories and requirements are looked at: the
+    checkouts are compared to the tags known locally.
+    """
+    name, specific_tags = session.get_environ_info()
+    channel = session.channel
+    deps = session.deps
+    commands = []
+    if is_git():
+        commands.append('git submodule update')
+    commands.append(update_cmd(name, channel, specific_tags, options.force))
+    update = plan.add('Updating the repo', commands)
+
+    location = os.getcwd()
+    deps_dir = os.path.join(location, 'deps')
+    parallel = options.jobs > 1 and len(deps) > 1
+    try:
+        checkouts = []
+        for dep in deps:
+            target = os.path.join(deps_dir, os.path.basename(dep))
+            checkout, skip = _plan_checkout(dep, deps_dir, channel,
+                                            specific_tags)
+            develop, skip_develop = _plan_develop(target, options.reinstall,
+                                                  skip is None)
+            if parallel:
+                checkouts.append((dep, develop, skip_develop))
+                plan.add('Checking out %s' % dep, checkout, skip,
+                         after=[update])
+            else:
+                both = skip is not None and skip_develop is not None
+                plan.add('Getting %s' % dep, checkout + develop,
+                         both and skip or None)
+
+        for index, (dep, develop, skip) in enumerate(checkouts):
+            after = None
+            if index == 0:
+                after = range(update + 1, update + 1 + len(checkouts))
+            plan.add('Installing %s' % dep, develop, skip, after=after)
+    finally:
+        os.chdir(location)
+
+    reqname = '%s-reqs.txt' % channel
+    if not os.path.exists(reqname):
+        plan.add('Building External dependencies', [], 'no %s' % reqname)
+    else:
+        lines, install, __ = requirements_to_install(reqname, options.index,
+                                                     options.extras, PYTHON,
+                                                     options.reinstall)
+        if not install:
+            plan.add('Building External dependencies', [],
+                     'all requirements are already satisfied')
+        else:
+            plan.add('Building External dependencies',
+                     ['%s install -i %s -U (%d of %d requirements)'
+                      % (PIP, options.index, len(install), len(lines))])
+
+    develop, skip = _plan_develop(location, options.reinstall, moved=False)
+    plan.add('Now building the app itself', develop, skip)
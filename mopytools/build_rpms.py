@@ -36,14 +36,24 @@
 import os
 import sys
 import shutil
-import subprocess
+import tarfile
+import tempfile
+import time
+import hashlib
+import threading
+import json
 
 from mopytools.util import (timeout, get_options, step, get_channel,
-                            split_version, get_spec_file, run,
+                            resolve_requirements, get_spec_file, run,
                             PYTHON, PYPI2RPM, PYPI, has_changes,
-                            get_non_pinned, DependencyError)
-from mopytools.build import get_environ_info, updating_repo
-from mopytools.build_app import main as build_app
+                            get_non_pinned, DependencyError, run_jobs,
+                            get_metadata, read_requirements, get_revision,
+                            BackgroundJob)
+from mopytools.build import BuildSession
+from mopytools.build_app import buildapp_session, plan_buildapp
+from mopytools.plan import (Plan, load_durations, save_durations,
+                            DURATIONS_FILE, record_duration)
+from mopytools.distributed import Coordinator, work, copy
 
 
 @timeout(4.0)
@@ -57,15 +67,71 @@ def main():
                       {"dest": "remove_dir",
                        "action": "store_true",
                        "default": False,
-                       "help": "Delete the target directory if it exists."}]]
+                       "help": "Delete the target directory if it exists."}],
+                     [("--rpm-cache",),
+                      {"dest": "rpm_cache",
+                       "help": "Directory where built RPMs are cached",
+                       "default": None}],
+                     [("--rpm-cache-size",),
+                      {"dest": "rpm_cache_size",
+                       "help": "Maximum size of the RPM cache, in MB",
+                       "default": 2048, "type": "int"}],
+                     [("--resume",),
+                      {"dest": "resume",
+                       "action": "store_true",
+                       "default": False,
+                       "help": "Skip the RPMs a previous run already built "
+                               "from the same sources."}],
+                     [("--coordinator",),
+                      {"dest": "coordinator",
+                       "help": "Hand out the RPM builds to the workers "
+                               "connecting to this host:port",
+                       "default": None}],
+                     [("--worker",),
+                      {"dest": "worker",
+                       "help": "Build the RPMs handed out by the "
+                               "coordinator at this host:port",
+                       "default": None}],
+                     [("--worker-wait",),
+                      {"dest": "worker_wait",
+                       "help": "Seconds a worker waits for its "
+                               "coordinator to listen, which only "
+                               "happens once buildapp is over "
+                               "(default: 1800)",
+                       "default": 1800., "type": "float"}]]
 
     options, args = get_options(extra_options)
 
+    if options.worker is not None:
+        run_workers(address=options.worker, jobs=options.jobs,
+                    options=options, wait=options.worker_wait)
+        return
+
     if options.dist_dir is None:
         options.dist_dir = os.path.join(os.getcwd(), 'rpms')
 
+    if len(args) > 0:
+        deps = [dep.strip() for dep in args[0].split(',')]
+    else:
+        deps = []
+
+    # get the channel
+    channel = get_channel(options)
+    print('The current channel is %s.' % channel)
+    session = BuildSession(deps, channel, options.force, options.timeout,
+                           options.verbose)
+
+    if options.plan:
+        plan = Plan(load_durations())
+        plan_buildapp(session, options, plan)
+        plan_buildrpms(session, options, plan)
+        plan.display()
+        return
+
     if os.path.exists(options.dist_dir):
-        if options.remove_dir:
+        if options.remove_dir and options.resume:
+            print('Resuming, keeping the existing directory.')
+        elif options.remove_dir:
             # we want to clean up the dir before we start
             print('Removing existing directory.')
             shutil.rmtree(options.dist_dir)
@@ -73,100 +139,165 @@ def main():
     else:
         os.mkdir(options.dist_dir)
 
-    if len(args) > 0:
-        deps = [dep.strip() for dep in args[0].split(',')]
-    else:
-        deps = []
-
     # building the app first (this can be quick, just to refresh the channel in
-    # case it's needed)
-    build_app()
-
-    # get the channel
-    channel = get_channel(options)
-    print('The current channel is %s.' % channel)
-    _buildrpms(deps, channel, options)
+    # case it's needed), in the same session so the repos are only looked
+    # at once
+    durations = os.path.abspath(DURATIONS_FILE)
+    try:
+        buildapp_session(session, options)
+        _buildrpms(deps, channel, options, session)
+    finally:
+        save_durations(durations)
 
 
 @step('Building RPMS')
-def _buildrpms(deps, channel, options):
+def _buildrpms(deps, channel, options, session=None):
+    if session is None:
+        session = BuildSession(deps, channel, options.force, options.timeout,
+                               options.verbose)
+
     # check the environ
-    name, specific_tags = get_environ_info(deps)
+    name, specific_tags = session.get_environ_info()
 
     # updating the repo
-    updating_repo(name, channel, specific_tags, options.force)
+    session.update_repo()
 
-    # building the internal req RPMS
-    build_core_rpm(deps, channel, specific_tags, options)
+    # what was built, for --resume
+    journal = Journal(options.dist_dir, getattr(options, 'resume', False))
 
-    # building the internal req RPMS
-    build_deps_rpms(deps, channel, specific_tags, options)
+    if getattr(options, 'coordinator', None) is not None:
+        # the workers build everything
+        coordinate(session, options, journal)
+        return
 
-    # building the external deps now
-    build_external_deps_rpms(channel, options)
+    # the external deps don't need the checkouts: they are built in the
+    # background, mostly waiting for the network, while the internal RPMS
+    # are built
+    external = BackgroundJob(build_external_deps_rpms, channel, options,
+                             journal)
+    try:
+        # building the internal req RPMS
+        build_core_rpm(deps, channel, specific_tags, options, session,
+                       journal)
+
+        # building the internal req RPMS
+        build_deps_rpms(deps, channel, specific_tags, options, session,
+                        journal)
+    except BaseException:
+        code, output = external.stop()
+        _print_section('RPMS for external deps', external.duration,
+                       'interrupted', output)
+        raise
+
+    code, output = external.wait()
+    status = code == 0 and 'ok' or 'failed with code %s' % code
+    _print_section('RPMS for external deps', external.duration, status,
+                   output)
+    if code != 0:
+        sys.exit(code)
+
+
+def _print_section(name, duration, status, output):
+    print('\n--- %s (%.1fs): %s' % (name, duration, status))
+    output = output.strip()
+    if output:
+        print(output)
 
 
 _MAJOR, _MINOR = sys.version_info[0], sys.version_info[1]
 _PYTHON = 'python%d%d' % (_MAJOR, _MINOR)
 
 
-def _build_rpm(channel, options):
-    if has_changes() and channel != 'dev' and not options.force:
+def _check_changes(channel, options, session=None):
+    if session is not None:
+        dirty = session.has_changes()
+    else:
+        dirty = has_changes()
+
+    if dirty and channel != 'dev' and not options.force:
         print('The code was changed, aborting !')
         print('Use the dev channel if you change locally the code')
         sys.exit(0)
 
-    # removing any build dir
-    if os.path.exists('build'):
-        shutil.rmtree('build')
 
-    cmd_options = {'dist': options.dist_dir}
-    cmd = ("--command-packages=pypi2rpm.command bdist_rpm2 "
-           "--dist-dir=%(dist)s --binary-only")
+def _setup_rpm_args():
+    """Returns the setup.py arguments that build the RPM of the project
+    in the current dir, but its --dist-dir."""
+    cmd = "--command-packages=pypi2rpm.command bdist_rpm2 --binary-only"
 
     # where's the spec file ?
     spec_file = get_spec_file()
 
     # if there's a spec file we use it
     if spec_file is not None:
-        cmd_options['spec'] = spec_file
-        cmd += ' --spec-file=%(spec)s'
-    else:
-        # if not we define a python-name for the rpm
-        # grab the name and create a normalized one
-        popen = subprocess.Popen('%s setup.py --name' % sys.executable,
-                                 stdout=subprocess.PIPE, shell=True)
-        name = [line for line in popen.stdout.read().split('\n') if line != '']
-        name = name[-1].strip().lower()
+        return cmd + ' --spec-file=%s' % os.path.basename(spec_file)
+
+    # if not we define a python-name for the rpm
+    # grab the name and create a normalized one
+    name = get_metadata().name
+    if name is None:
+        raise IOError('Unable to find the name of the project in %s.'
+                      % os.getcwd())
+    name = name.lower()
+
+    if not name.startswith('python'):
+        name = '%s-%s' % (_PYTHON, name)
+    elif name.startswith('python-'):
+        name = '%s-%s' % (_PYTHON, name[len('python-'):])
+
+    return cmd + ' --name=%s' % name
 
-        if not name.startswith('python'):
-            name = '%s-%s' % (_PYTHON, name)
-        elif name.startswith('python-'):
-            name = '%s-%s' % (_PYTHON, name[len('python-'):])
 
-        cmd_options['name'] = name
-        cmd += ' --name=%(name)s'
+def _build_rpm(channel, options, session=None, unit=None, journal=None):
+    _check_changes(channel, options, session)
 
-    # now running the cmd
-    run('%s setup.py %s' % (PYTHON, cmd % cmd_options))
+    args = _setup_rpm_args()
+    key = None
+    if journal is not None:
+        key = _source_key(args, session)
+        if journal.is_done(unit, key):
+            print('Already built, skipping')
+            return
+
+    # removing any build dir
+    if os.path.exists('build'):
+        shutil.rmtree('build')
+
+    # now running the cmd, in a scratch dir so a failure never leaves
+    # partial files in dist_dir
+    scratch_dir = tempfile.mkdtemp(prefix='mopytools-')
+    try:
+        run('%s setup.py %s --dist-dir=%s' % (PYTHON, args, scratch_dir))
+        built = os.listdir(scratch_dir)
+        for file_ in built:
+            shutil.move(os.path.join(scratch_dir, file_),
+                        os.path.join(options.dist_dir, file_))
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    if journal is not None:
+        journal.record(unit, key, built)
 
 
 @step("Building the project's RPM")
-def build_core_rpm(deps, channel, specific_tags, options):
-    _build_rpm(channel, options)
+def build_core_rpm(deps, channel, specific_tags, options, session=None,
+                   journal=None):
+    _build_rpm(channel, options, session, 'app', journal)
 
 
 @step("Building %(dep)s")
-def build_dep_rpm(dep='', deps_dir='deps', channel='prod', options=None):
+def build_dep_rpm(dep='', deps_dir='deps', channel='prod', options=None,
+                  session=None, journal=None):
     target = os.path.join(deps_dir, os.path.basename(dep))
     if not os.path.exists(target):
         print('You need to build your deps first.')
     os.chdir(target)
-    _build_rpm(channel, options)
+    _build_rpm(channel, options, session, dep, journal)
 
 
 @step('Building RPMS for internal deps')
-def build_deps_rpms(deps, channel, specific_tags, options):
+def build_deps_rpms(deps, channel, specific_tags, options, session=None,
+                    journal=None):
     # for each dep, we want to get the channel's version
     location = os.getcwd()
     try:
@@ -177,14 +308,13 @@ def build_deps_rpms(deps, channel, specific_tags, options):
 
         for dep in deps:
             build_dep_rpm(dep=dep, deps_dir=deps_dir, channel=channel,
-                          options=options)
+                          options=options, session=session, journal=journal)
     finally:
         os.chdir(location)
 
 
-@step("Building %(project)s at version %(version)s")
-def build_rpm(project=None, dist_dir='rpms', version=None, index=PYPI,
-              download_cache=None):
+def _pypi2rpm_cmd(project, dist_dir, version=None, index=PYPI,
+                  download_cache=None):
     options = {'dist_dir': dist_dir, 'index': index}
     if version is None:
         cmd = "--index=%(index)s --dist-dir=%(dist_dir)s"
@@ -196,11 +326,292 @@ def build_rpm(project=None, dist_dir='rpms', version=None, index=PYPI,
     if download_cache is not None:
         cmd += ' --download-cache=%s' % download_cache
 
-    run('%s %s %s' % (PYPI2RPM, cmd % options, project))
+    return '%s %s %s' % (PYPI2RPM, cmd % options, project)
+
+
+def _link(source, target):
+    """Hardlinks source to target, or copies it across devices."""
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _rpm_key(project, version, index=PYPI):
+    """Returns a hash of what an external RPM is built from, or None if
+    it can't be known."""
+    if version is None:
+        # the latest version can change anytime
+        return None
+    data = '\n'.join([project.lower(), version, _PYTHON, index])
+    return hashlib.sha1(data).hexdigest()
+
+
+def _source_key(args, session=None):
+    """Returns a hash of what the RPM of the checkout in the current dir
+    is built from, or None if it has local changes."""
+    if session is not None:
+        revision, dirty = session.get_revision(), session.has_changes()
+    else:
+        revision, dirty = get_revision(), has_changes()
+    if revision is None or dirty:
+        return None
+    data = '\n'.join([revision, args, PYTHON, _PYTHON])
+    return hashlib.sha1(data).hexdigest()
+
+
+class Journal(object):
+    """Journal of the RPMs built in a dist dir.
+
+    Each finished unit of work is appended to the journal file with the
+    hash of its inputs and the files it built, so an interrupted build
+    can be resumed. A unit is done when its inputs did not change and its
+    files are still in the dist dir.
+    """
+    filename = '.mopytools-journal'
+
+    def __init__(self, dist_dir, resume=False):
+        self.dist_dir = dist_dir
+        self.path = os.path.join(dist_dir, self.filename)
+        self.units = {}
+        self.skipped = 0
+        if resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # interrupted while writing
+                        continue
+                    self.units[entry['unit']] = entry
+        else:
+            open(self.path, 'w').close()
+
+    def is_done(self, unit, key):
+        entry = self.units.get(unit)
+        if key is None or entry is None or entry['key'] != key:
+            return False
+        for file_ in entry['files']:
+            if not os.path.exists(os.path.join(self.dist_dir, file_)):
+                return False
+        self.skipped += 1
+        return True
+
+    def record(self, unit, key, files):
+        if key is None:
+            return
+        entry = {'unit': unit, 'key': key, 'files': list(files)}
+        self.units[unit] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class RPMCache(object):
+    """Cache of the RPMs built by pypi2rpm.
+
+    Each entry is a directory named after a hash of the project name,
+    its version, the Python version and the index, containing the RPMs
+    built for it. The least recently used entries are removed when the
+    cache grows over max_size bytes.
+    """
+    def __init__(self, path, max_size=2048 * 1024 * 1024):
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def key(self, project, version, index=PYPI):
+        return _rpm_key(project, version, index)
+
+    def get(self, key, dist_dir):
+        """Links the cached RPMs into dist_dir.
+
+        Returns the list of files, or None if the entry is not cached.
+        """
+        if key is None:
+            return None
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            return None
+        files = os.listdir(entry)
+        for file_ in files:
+            _link(os.path.join(entry, file_), os.path.join(dist_dir, file_))
+        # marking the entry as recently used
+        os.utime(entry, None)
+        return files
+
+    def put(self, key, paths):
+        """Adds the RPMs located at paths under key."""
+        if key is None:
+            return
+        entry = os.path.join(self.path, key)
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        for path in paths:
+            _link(path, os.path.join(tmp, os.path.basename(path)))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # the entry was created by a concurrent build
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum([os.path.getsize(os.path.join(entry, file_))
+                            for file_ in os.listdir(entry)])
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                # removed by a concurrent eviction
+                continue
+            total += size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            __, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def report(self):
+        print('RPM cache: %d hit(s), %d miss(es)' % (self.hits, self.misses))
+
+
+def get_rpm_cache(options):
+    """Returns the RPMCache configured in options, if any."""
+    path = getattr(options, 'rpm_cache', None)
+    if path is None:
+        return None
+    size = getattr(options, 'rpm_cache_size', 2048)
+    return RPMCache(path, size * 1024 * 1024)
+
+
+@step("Building %(project)s at version %(version)s")
+def build_rpm(project=None, dist_dir='rpms', version=None, index=PYPI,
+              download_cache=None, cache=None):
+    scratch_root = tempfile.mkdtemp(prefix='mopytools-')
+    try:
+        return _build_rpm_job(project, version, dist_dir,
+                              os.path.join(scratch_root, 'build'), index,
+                              download_cache, cache)
+    finally:
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+
+def _build_rpm_job(project, version, dist_dir, scratch_dir, index=PYPI,
+                   download_cache=None, cache=None):
+    """Builds one RPM into its own scratch dir, then moves it to dist_dir.
+
+    That way a failing or killed build never leaves partial files in
+    dist_dir. When a cache is provided, the RPMs are taken from it if
+    possible, and stored in it otherwise.
+
+    Returns a (files, cache hit) tuple.
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(project, version, index)
+        files = cache.get(key, dist_dir)
+        if files is not None:
+            print('Found in the RPM cache')
+            return files, True
+
+    os.mkdir(scratch_dir)
+    cmd = _pypi2rpm_cmd(project, scratch_dir, version, index,
+                        download_cache)
+    run(cmd)
+    built = os.listdir(scratch_dir)
+    if cache is not None:
+        cache.put(key, [os.path.join(scratch_dir, file_) for file_ in built])
+    for file_ in built:
+        shutil.move(os.path.join(scratch_dir, file_),
+                    os.path.join(dist_dir, file_))
+    return built, False
+
+
+@step('Building %(count)d RPMS, %(jobs)d at a time')
+def build_rpms(reqs=None, count=0, jobs=1, options=None, cache=None,
+               journal=None):
+    """Builds the (project, version) reqs in parallel.
+
+    Stops at the first failure. Returns a list of
+    (project, version, duration) for the builds that succeeded.
+    """
+    scratch_root = tempfile.mkdtemp(prefix='mopytools-')
+    calls = []
+    for index, (project, version) in enumerate(reqs):
+        scratch_dir = os.path.join(scratch_root, str(index))
+        calls.append(((project, version, options.dist_dir, scratch_dir,
+                       options.index, options.download_cache, cache), {}))
+
+    durations = []
+    try:
+        for index, code, res, output, duration in run_jobs(_build_rpm_job,
+                                                            calls, jobs):
+            project, version = reqs[index]
+            if code != 0:
+                print('\nBuilding %s at version %s failed, aborting.'
+                      % (project, version))
+                print(output)
+                sys.exit(code)
+
+            if cache is not None:
+                cache.record(res[1])
+            if not res[1]:
+                # the jobs are not steps, their durations are kept here
+                # for --plan
+                record_duration('Building %s at version %s'
+                                % (project, version), duration)
+            if journal is not None:
+                _record(journal, project, version, options.index, res[0])
+            durations.append((project, version, duration))
+    finally:
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+    return durations
+
+
+def print_durations(durations):
+    """Prints the builds durations, slowest first."""
+    print('\nBuild durations:')
+    durations = sorted(durations, key=lambda res: res[2], reverse=True)
+    for project, version, duration in durations:
+        print('    %-50s %8.1fs' % ('%s %s' % (project, version), duration))
+    total = sum([res[2] for res in durations])
+    print('    %-50s %8.1fs' % ('Total', total))
+
+
+def _unit(project, version):
+    return '%s==%s' % (project, version)
+
+
+def _record(journal, project, version, index, files):
+    journal.record(_unit(project, version),
+                   _rpm_key(project, version, index), files)
+
+
+@step('Resolving the requirements versions')
+def resolve_reqs(lines=None, index=PYPI):
+    return resolve_requirements(lines, index)
 
 
 @step('Building RPMS for external deps')
-def build_external_deps_rpms(channel, options):
+def build_external_deps_rpms(channel, options, journal=None):
     # let's build the external reqs RPMS
     req_file = os.path.join(os.getcwd(), '%s-reqs.txt' % channel)
     if not os.path.exists(req_file):
@@ -215,12 +626,284 @@ def build_external_deps_rpms(channel, options):
             raise DependencyError('Unpinned dependencies: %s' % deps)
 
     # we have a requirement file, we can go ahead and feed pypi2rpm with it
+    lines = []
     with open(req_file) as f:
         for line in f.readlines():
             line = line.strip()
             if not line or line.startswith('#'):
                 continue
-            project, version = split_version(line)
-            build_rpm(project=project, dist_dir=options.dist_dir,
-                      version=version, index=options.index,
-                      download_cache=options.download_cache)
+            lines.append(line)
+
+    reqs = resolve_reqs(lines=lines, index=options.index)
+    if journal is not None:
+        count = len(reqs)
+        reqs = [(project, version) for project, version in reqs
+                if not journal.is_done(_unit(project, version),
+                                       _rpm_key(project, version,
+                                                options.index))]
+        if len(reqs) < count:
+            print('%d of %d RPMS already built' % (count - len(reqs), count))
+
+    cache = get_rpm_cache(options)
+    jobs = getattr(options, 'jobs', 1)
+    if jobs > 1 and len(reqs) > 1:
+        durations = build_rpms(reqs=reqs, count=len(reqs), jobs=jobs,
+                               options=options, cache=cache, journal=journal)
+    else:
+        durations = []
+        for project, version in reqs:
+            start = time.time()
+            files, hit = build_rpm(project=project,
+                                   dist_dir=options.dist_dir,
+                                   version=version, index=options.index,
+                                   download_cache=options.download_cache,
+                                   cache=cache)
+            if cache is not None:
+                cache.record(hit)
+            if journal is not None:
+                _record(journal, project, version, options.index, files)
+            durations.append((project, version, time.time() - start))
+
+    print_durations(durations)
+    if cache is not None:
+        cache.report()
+
+
+def plan_buildrpms(session, options, plan):
+    """Adds the steps buildrpms would run after buildapp to plan.
+
+    The versions of the external deps are resolved against the index.
+    """
+    channel = session.channel
+    # the external deps only wait for buildapp, see _buildrpms
+    buildapp = plan.steps and [len(plan.steps)] or []
+    build = '%s setup.py bdist_rpm2 --dist-dir=%s' % (PYTHON,
+                                                      options.dist_dir)
+    plan.add("Building the project's RPM", [build])
+    for dep in session.deps:
+        plan.add('Building %s' % dep, [build])
+
+    req_file = os.path.join(os.getcwd(), '%s-reqs.txt' % channel)
+    if not os.path.exists(req_file):
+        return
+
+    lines = []
+    with open(req_file) as f:
+        for line in f.readlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            lines.append(line)
+
+    cache = get_rpm_cache(options)
+    previous = buildapp
+    for project, version in resolve_requirements(lines, options.index):
+        name = 'Building %s at version %s' % (project, version)
+        key = cache is not None and cache.key(project, version,
+                                              options.index)
+        if key and os.path.isdir(os.path.join(cache.path, key)):
+            plan.add(name, [], 'in the RPM cache', buildapp)
+            continue
+        cmd = _pypi2rpm_cmd(project, options.dist_dir, version,
+                            options.index, options.download_cache)
+        # the external deps are built in parallel with --jobs
+        number = plan.add(name, [cmd],
+                          after=options.jobs > 1 and buildapp or previous)
+        previous = [number]
+
+
+# directories at the root of a checkout that are not sent to the workers
+_NOT_SENT = ('build', 'deps')
+
+# what virtualenv creates when the checkout is also the virtualenv
+_VIRTUALENV = ('bin', 'include', 'lib', 'lib64', 'local', '.Python')
+
+
+def _archive(location, exclude=()):
+    """Returns a temporary file with a tarball of a checkout.
+
+    The virtualenv the checkout may hold is not part of it.
+    """
+    not_sent = _NOT_SENT
+    if os.path.exists(os.path.join(location, 'bin', 'activate')):
+        not_sent += _VIRTUALENV
+
+    def _filter(info):
+        parts = info.name.split('/')
+        if parts[-1] in ('.git', '.hg'):
+            return None
+        if len(parts) == 2 and parts[1] in not_sent:
+            return None
+        path = os.path.normpath(os.path.join(location, info.name))
+        if path in exclude:
+            return None
+        return info
+
+    archive = tempfile.TemporaryFile()
+    tar = tarfile.open(fileobj=archive, mode='w:gz')
+    try:
+        tar.add(location, arcname='.', filter=_filter)
+    finally:
+        tar.close()
+    return archive
+
+
+def _distributed_jobs(session, options, cache, journal=None):
+    """Returns the jobs of the build plan: the app, the internal deps,
+    then the external deps that are not in the cache nor in the journal.
+    """
+    location = os.getcwd()
+    jobs = []
+
+    def _add(**job):
+        if journal is not None and journal.is_done(job['unit'], job['key']):
+            return
+        job['id'] = len(jobs)
+        jobs.append(job)
+
+    def _add_source(name, unit):
+        _check_changes(session.channel, options, session)
+        args = _setup_rpm_args()
+        _add(name=name, kind='setup', location=os.getcwd(), args=args,
+             unit=unit, key=_source_key(args, session))
+
+    _add_source("Building the project's RPM", 'app')
+
+    deps_dir = os.path.join(location, 'deps')
+    try:
+        for dep in session.deps:
+            target = os.path.join(deps_dir, os.path.basename(dep))
+            os.chdir(target)
+            _add_source('Building %s' % dep, dep)
+    finally:
+        os.chdir(location)
+
+    req_file = os.path.join(location, '%s-reqs.txt' % session.channel)
+    if not os.path.exists(req_file):
+        return jobs
+
+    lines = read_requirements(req_file)
+    for project, version in resolve_reqs(lines=lines, index=options.index):
+        if cache is not None:
+            key = cache.key(project, version, options.index)
+            hit = cache.get(key, options.dist_dir) is not None
+            cache.record(hit)
+            if hit:
+                continue
+        _add(name='Building %s at version %s' % (project, version),
+             kind='pypi2rpm', project=project, version=version,
+             index=options.index, unit=_unit(project, version),
+             key=_rpm_key(project, version, options.index))
+    return jobs
+
+
+@step('Building RPMS on the workers at %(address)s')
+def serve_jobs(address=None, coordinator=None):
+    def _done(job, result):
+        status = result['code'] == 0 and 'ok' or \
+            'failed with code %s' % result['code']
+        print('\n--- %s on %s (%.1fs): %s' % (job['name'], result['worker'],
+                                            result['duration'], status))
+        if result['code'] == 0:
+            record_duration(job['name'], result['duration'])
+        else:
+            print(result['output'])
+
+    coordinator.serve(_done)
+    if coordinator.error is not None:
+        print(coordinator.error)
+        sys.exit(1)
+    if coordinator.failure is not None:
+        sys.exit(coordinator.results[coordinator.failure]['code'])
+
+
+def coordinate(session, options, journal=None):
+    """Publishes the build plan to the workers, and waits until they
+    built it."""
+    cache = get_rpm_cache(options)
+    jobs = _distributed_jobs(session, options, cache, journal)
+    dist_dir = os.path.abspath(options.dist_dir)
+
+    def _payload(job):
+        if job['kind'] != 'setup':
+            return None
+        return _archive(job['location'], exclude=(dist_dir,))
+
+    def _on_result(job, result, paths):
+        if cache is not None and job['kind'] == 'pypi2rpm':
+            cache.put(cache.key(job['project'], job['version'],
+                                options.index), paths)
+        if journal is not None:
+            journal.record(job['unit'], job['key'], result['files'])
+
+    coordinator = Coordinator(jobs, options.coordinator, dist_dir, _payload,
+                              _on_result)
+    serve_jobs(address=coordinator.address, coordinator=coordinator)
+    if cache is not None:
+        cache.report()
+
+
+class _Builder(object):
+    """Builds the jobs of a coordinator, each in its own scratch dir."""
+    def __init__(self, options):
+        self.options = options
+        self.scratch_root = tempfile.mkdtemp(prefix='mopytools-')
+
+    def close(self):
+        shutil.rmtree(self.scratch_root, ignore_errors=True)
+
+    def cleanup(self, job):
+        shutil.rmtree(os.path.join(self.scratch_root, str(job['id'])),
+                      ignore_errors=True)
+
+    def build(self, job, stream):
+        scratch_dir = os.path.join(self.scratch_root, str(job['id']))
+        os.mkdir(scratch_dir)
+        rpms = os.path.join(scratch_dir, 'rpms')
+        os.mkdir(rpms)
+        print('Building %s' % job['name'])
+        if job['kind'] == 'setup':
+            source = os.path.join(scratch_dir, 'source')
+            archive = tempfile.TemporaryFile()
+            copy(stream, archive, job['size'])
+            archive.seek(0)
+            tar = tarfile.open(fileobj=archive, mode='r:gz')
+            try:
+                tar.extractall(source)
+            finally:
+                tar.close()
+                archive.close()
+            cmd = 'cd %s && %s setup.py %s --dist-dir=%s' % (
+                source, PYTHON, job['args'], rpms)
+        else:
+            cmd = _pypi2rpm_cmd(job['project'], rpms, job['version'],
+                                job['index'], self.options.download_cache)
+
+        try:
+            code, out, err = run(cmd, self.options.timeout, allow_exit=True)
+        except SystemExit, e:
+            # timed out
+            return e.code or 1, '', []
+        return code, out + err, [os.path.join(rpms, file_)
+                                 for file_ in os.listdir(rpms)]
+
+
+@step('Building RPMS for %(address)s, %(jobs)d at a time')
+def run_workers(address=None, jobs=1, options=None, wait=1800.):
+    """Runs `jobs` workers building the jobs of the coordinator.
+
+    The workers can be started first: they wait up to `wait` seconds for
+    the coordinator, which only listens once it ran buildapp.
+    """
+    builder = _Builder(options)
+    workers = [threading.Thread(target=work, args=(address, builder.build),
+                                kwargs={'cleanup': builder.cleanup,
+                                        'retry': wait})
+               for i in range(max(1, jobs))]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        builder.close()
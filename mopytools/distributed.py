@@ -0,0 +1,357 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Distributed builds: a coordinator hands out jobs to workers over TCP.
+
+The protocol is made of JSON messages, one per line. A message with a
+"size" field is followed by that many bytes of raw data, and a message
+with a "files" field by the content of each listed file, in order.
+
+A worker asks for work with {"op": "get"}, and the coordinator answers
+with a job, with {"op": "wait"} when all the remaining jobs are being
+built by other workers, or with {"op": "done"}. The worker then sends
+{"op": "result"} with the exit code, the output and the built files.
+Workers and coordinator can be started in any order: the coordinator
+only listens once it ran buildapp and planned the build, so the workers
+retry connecting until their deadline.
+
+If a worker goes away in the middle of a job, the job is given to the
+next worker that asks for one. When all the workers went away, the
+coordinator gives up after a while.
+
+Builds take any time: the connections don't use the default socket
+timeout the scripts set for the index requests.
+"""
+import os
+import json
+import time
+import socket
+import shutil
+import tempfile
+import threading
+from collections import deque
+from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
+
+
+_CHUNK = 64 * 1024
+
+
+def parse_address(address):
+    """Turns a "host:port" string into a (host, port) tuple."""
+    host, port = address.rsplit(':', 1)
+    return host or '127.0.0.1', int(port)
+
+
+def send(stream, message, data=None):
+    """Sends a message, followed by the content of the data file if any.
+    """
+    if data is not None:
+        data.seek(0, os.SEEK_END)
+        message = dict(message, size=data.tell())
+        data.seek(0)
+    stream.write(json.dumps(message) + '\n')
+    if data is not None:
+        shutil.copyfileobj(data, stream, _CHUNK)
+    stream.flush()
+
+
+def receive(stream):
+    """Returns the next message, or None if the connection was closed."""
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def copy(source, target, size):
+    """Copies size bytes from the source stream to the target file."""
+    while size > 0:
+        chunk = source.read(min(size, _CHUNK))
+        if not chunk:
+            raise IOError('Connection closed in the middle of a transfer')
+        target.write(chunk)
+        size -= len(chunk)
+
+
+def send_files(stream, message, paths):
+    message = dict(message, files=[(os.path.basename(path),
+                                    os.path.getsize(path))
+                                   for path in paths])
+    stream.write(json.dumps(message) + '\n')
+    for path in paths:
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, stream, _CHUNK)
+    stream.flush()
+
+
+def receive_files(stream, message, target_dir):
+    """Writes the files announced by message to target_dir.
+
+    Returns their paths.
+    """
+    paths = []
+    for name, size in message.get('files', []):
+        path = os.path.join(target_dir, os.path.basename(name))
+        with open(path, 'wb') as f:
+            copy(stream, f, size)
+        paths.append(path)
+    return paths
+
+
+class _Handler(StreamRequestHandler):
+
+    def setup(self):
+        # accepted sockets get the default timeout
+        self.request.settimeout(None)
+        StreamRequestHandler.setup(self)
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        coordinator.connected()
+        job = None
+        try:
+            while True:
+                message = receive(self.rfile)
+                if message is None:
+                    break
+                if message['op'] == 'get':
+                    next_job = coordinator.next_job()
+                    if next_job in ('wait', 'done'):
+                        send(self.wfile, {'op': next_job})
+                        continue
+                    job = next_job
+                    payload = coordinator.payload(job)
+                    try:
+                        send(self.wfile, dict(job, op='job'), payload)
+                    finally:
+                        if payload is not None:
+                            payload.close()
+                elif message['op'] == 'result':
+                    coordinator.receive_result(job, message, self.rfile)
+                    job = None
+        except (IOError, socket.error, ValueError):
+            pass
+        finally:
+            if job is not None:
+                coordinator.requeue(job)
+            coordinator.disconnected()
+
+
+class _Server(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Coordinator(object):
+    """Hands out jobs to the workers that connect to address.
+
+    Each job is a dict with at least an "id" and a "name". payload(job)
+    can return a file sent along with the job. on_result(job, result,
+    paths) is called for each successful job, with the paths of the files
+    sent back by the worker, in a temporary directory of dist_dir. The
+    files are then moved to dist_dir.
+
+    Once workers connected, the build fails if none of them is connected
+    for `idle` seconds.
+    """
+    def __init__(self, jobs, address, dist_dir, payload=None,
+                 on_result=None, idle=60.):
+        self.jobs = dict((job['id'], job) for job in jobs)
+        self.pending = deque([job['id'] for job in jobs])
+        self.running = set()
+        self.results = {}
+        self.failure = None
+        self.error = None
+        self.workers = 0
+        self.idle = idle
+        self._left = None
+        self.dist_dir = dist_dir
+        self._payload = payload
+        self._on_result = on_result
+        self._lock = threading.Condition()
+        self._server = _Server(parse_address(address), _Handler)
+        self._server.coordinator = self
+        self.address = '%s:%d' % self._server.server_address
+
+    def payload(self, job):
+        if self._payload is None:
+            return None
+        return self._payload(job)
+
+    def next_job(self):
+        with self._lock:
+            if self.failure is not None or self._done():
+                return 'done'
+            if not self.pending:
+                return 'wait'
+            job = self.jobs[self.pending.popleft()]
+            job['start'] = time.time()
+            self.running.add(job['id'])
+            return job
+
+    def connected(self):
+        with self._lock:
+            self.workers += 1
+            self._left = None
+
+    def disconnected(self):
+        with self._lock:
+            self.workers -= 1
+            if self.workers == 0:
+                self._left = time.time()
+            self._lock.notify_all()
+
+    def requeue(self, job):
+        with self._lock:
+            if job['id'] in self.running:
+                self.running.remove(job['id'])
+                self.pending.appendleft(job['id'])
+                self._lock.notify_all()
+
+    def receive_result(self, job, message, stream):
+        tmp = tempfile.mkdtemp(dir=self.dist_dir, prefix='.tmp-')
+        try:
+            paths = receive_files(stream, message, tmp)
+            result = {'code': message['code'], 'output': message['output'],
+                      'files': [os.path.basename(path) for path in paths],
+                      'duration': time.time() - job['start'],
+                      'worker': message.get('worker')}
+            if result['code'] == 0:
+                if self._on_result is not None:
+                    self._on_result(job, result, paths)
+                for path in paths:
+                    os.rename(path, os.path.join(self.dist_dir,
+                                                 os.path.basename(path)))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        with self._lock:
+            self.running.discard(job['id'])
+            self.results[job['id']] = result
+            if result['code'] != 0 and self.failure is None:
+                self.failure = job['id']
+            self._lock.notify_all()
+
+    def _done(self):
+        return len(self.results) == len(self.jobs)
+
+    def serve(self, callback=None):
+        """Serves the jobs until they are all built, or one fails.
+
+        callback(job, result) is called in the calling thread for every
+        result, in the order they arrive. Returns the results by job id.
+        If the workers went away, error explains why the build stopped.
+        """
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        reported = set()
+        try:
+            with self._lock:
+                while True:
+                    for id_, result in self.results.items():
+                        if id_ not in reported:
+                            reported.add(id_)
+                            if callback is not None:
+                                callback(self.jobs[id_], result)
+                    if self.failure is not None or self._done():
+                        break
+                    if self._left is not None and \
+                            time.time() - self._left > self.idle:
+                        self.error = ('No workers left, %d jobs were not '
+                                      'built' % (len(self.jobs) -
+                                                 len(self.results)))
+                        break
+                    self._lock.wait(0.5)
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+        return self.results
+
+
+def work(address, build, retry=1800., cleanup=None):
+    """Builds the jobs of the coordinator at address until it is done.
+
+    build(job, stream) builds a job, reading its payload from stream if
+    needed, and returns a (code, output, paths) tuple. cleanup(job) is
+    called once the files are sent. Connecting is retried for `retry`
+    seconds, since the coordinator only listens once buildapp is over.
+
+    Returns the number of jobs built.
+    """
+    deadline = time.time() + retry
+    while True:
+        try:
+            sock = socket.create_connection(parse_address(address))
+            sock.settimeout(None)
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+    count = 0
+    rfile, wfile = sock.makefile('rb'), sock.makefile('wb')
+    name = socket.gethostname()
+    try:
+        while True:
+            send(wfile, {'op': 'get'})
+            job = receive(rfile)
+            if job is None or job['op'] == 'done':
+                break
+            if job['op'] == 'wait':
+                time.sleep(0.1)
+                continue
+            code, output, paths = build(job, rfile)
+            result = {'op': 'result', 'code': code, 'output': output,
+                      'worker': name}
+            try:
+                send_files(wfile, result, code == 0 and paths or [])
+            finally:
+                if cleanup is not None:
+                    cleanup(job)
+            count += 1
+    except socket.error:
+        # the coordinator went away
+        pass
+    finally:
+        # flushing to a closed connection fails
+        for stream in (rfile, wfile, sock):
+            try:
+                stream.close()
+            except socket.error:
+                pass
+    return count
@@ -0,0 +1,267 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Cache of the package index metadata.
+
+The versions published for a project are read from its simple index page,
+and kept on disk so that other builds on the same host don't download the
+same pages again. Past the time-to-live, cached pages are revalidated with
+a conditional request.
+"""
+import os
+import time
+import json
+import socket
+import hashlib
+import threading
+import urlparse
+
+
+# the distutils2 default, without importing its crawler
+DEFAULT_SIMPLE_INDEX_URL = "http://a.pypi.python.org/simple/"
+
+
+def project_url(index_url, project):
+    return '%s/%s/' % (index_url.rstrip('/'), project)
+
+
+def parse_versions(content, base_url, project=None):
+    """Returns the versions of the distributions linked in a simple index
+    page."""
+    from distutils2.index.simple import HREF
+    from distutils2.index.dist import get_infos_from_url, EXTENSIONS
+    from distutils2.index.errors import CantParseArchiveName
+    versions = set()
+    for match in HREF.finditer(content):
+        url = match.group(1).replace('&amp;', '&')
+        url = urlparse.urljoin(base_url, url)
+        if not [ext for ext in EXTENSIONS if ext in url]:
+            continue
+        try:
+            infos = get_infos_from_url(url, project)
+        except CantParseArchiveName:
+            continue
+        if infos is not None and infos['version'] is not None:
+            versions.add(infos['version'])
+    return sorted(versions)
+
+
+class ConnectionPool(threading.local):
+    """Keeps one keep-alive HTTP connection per host and per thread."""
+    def __init__(self, timeout=15):
+        self.timeout = timeout
+        self.connections = {}
+
+    def _get_connection(self, scheme, netloc):
+        connection = self.connections.get((scheme, netloc))
+        if connection is None:
+            import httplib
+            if scheme == 'https':
+                klass = httplib.HTTPSConnection
+            else:
+                klass = httplib.HTTPConnection
+            connection = klass(netloc, timeout=self.timeout)
+            self.connections[scheme, netloc] = connection
+        return connection
+
+    def _drop(self, scheme, netloc):
+        connection = self.connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def get(self, url, headers=None, redirects=5):
+        """Does a GET on url, following redirects.
+
+        Returns the (status, content, response) tuple.
+        """
+        import httplib
+        scheme, netloc, path, params, query, frag = urlparse.urlparse(url)
+        if query:
+            path += '?' + query
+
+        # a kept-alive connection may have been closed by the server
+        for attempt in (1, 2):
+            connection = self._get_connection(scheme, netloc)
+            try:
+                connection.request('GET', path or '/', headers=headers or {})
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                self._drop(scheme, netloc)
+                if attempt == 2:
+                    raise
+
+        if response.will_close:
+            self._drop(scheme, netloc)
+
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307) and location and \
+                redirects > 0:
+            return self.get(urlparse.urljoin(url, location), headers,
+                            redirects - 1)
+        return response.status, content, response
+
+    def close(self):
+        for key in list(self.connections):
+            self._drop(*key)
+
+
+class IndexCache(object):
+    """Keeps the versions of the projects found on package indexes.
+
+    Entries are kept in memory, and also in the `path` directory when
+    provided. An entry younger than `ttl` seconds is used as is, an older
+    one is revalidated using its ETag and Last-Modified headers. In
+    offline mode, the cached entries are always used and no request is
+    made.
+    """
+    def __init__(self, path=None, ttl=3600, offline=False, timeout=15):
+        self.path = path
+        self.ttl = ttl
+        self.offline = offline
+        self._entries = {}
+        self._connections = ConnectionPool(timeout)
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+    def _key(self, index_url, project):
+        return hashlib.sha1('%s\n%s' % (index_url.rstrip('/'),
+                                        project.lower())).hexdigest()
+
+    def _load(self, key):
+        if key in self._entries:
+            return self._entries[key]
+        if self.path is None:
+            return None
+        filename = os.path.join(self.path, key)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            try:
+                entry = json.load(f)
+            except ValueError:
+                # truncated or corrupted file
+                return None
+        self._entries[key] = entry
+        return entry
+
+    def _save(self, key, entry):
+        self._entries[key] = entry
+        if self.path is None:
+            return
+        filename = os.path.join(self.path, key)
+        tmp = '%s.%d' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, filename)
+
+    def fetch(self, url, headers):
+        """Does a GET on url.
+
+        Returns a (status, content, response headers) tuple. status is 304
+        when the conditional headers matched. HTTP(S) indexes are reached
+        through kept-alive connections.
+        """
+        if urlparse.urlparse(url)[0] in ('http', 'https'):
+            status, content, response = self._connections.get(url, headers)
+            if status >= 400:
+                raise IOError('%s returned a %d' % (url, status))
+            return status, content, response
+
+        import urllib2
+        request = urllib2.Request(url, headers=headers)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return 304, None, e.info()
+            raise
+        try:
+            return response.getcode(), response.read(), response.info()
+        finally:
+            response.close()
+
+    def get_versions(self, project, index_url=DEFAULT_SIMPLE_INDEX_URL):
+        """Returns the list of the versions of project."""
+        key = self._key(index_url, project)
+        entry = self._load(key)
+
+        if self.offline:
+            if entry is None:
+                raise IOError('%s is not in the index cache' % project)
+            return list(entry['versions'])
+
+        if entry is not None and time.time() - entry['checked'] < self.ttl:
+            return list(entry['versions'])
+
+        url = project_url(index_url, project)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        # urllib2.URLError is an IOError
+        import httplib
+        try:
+            status, content, info = self.fetch(url, headers)
+        except (IOError, httplib.HTTPException), e:
+            if entry is None:
+                raise
+            print('Could not reach %s (%s), using the cached versions.'
+                  % (url, e))
+            return list(entry['versions'])
+
+        if status != 304:
+            entry = {'versions': parse_versions(content, url, project),
+                     'etag': info.getheader('ETag'),
+                     'last_modified': info.getheader('Last-Modified')}
+        entry['checked'] = time.time()
+        self._save(key, entry)
+        return list(entry['versions'])
+
+
+_CACHE = IndexCache()
+
+
+def get_index_cache():
+    return _CACHE
+
+
+def set_index_cache(cache):
+    global _CACHE
+    _CACHE = cache
@@ -0,0 +1,156 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Build plans: what buildapp and buildrpms would do, without doing it.
+
+The duration of every step is recorded, and kept between runs in the
+durations file of the app, so a plan can show the cost of each step.
+"""
+import os
+import sys
+import json
+import tempfile
+
+
+DURATIONS_FILE = '.mopytools-durations'
+
+# step name -> duration in seconds, for the current run
+_DURATIONS = {}
+
+
+def record_duration(name, duration):
+    _DURATIONS[name] = duration
+
+
+def get_durations():
+    return _DURATIONS
+
+
+def load_durations(path=DURATIONS_FILE):
+    """Returns the durations recorded by the previous runs."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_durations(path=DURATIONS_FILE):
+    """Adds the durations of the current run to the file."""
+    durations = load_durations(path)
+    durations.update(_DURATIONS)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _format_duration(duration):
+    if duration is None:
+        return '?'
+    if duration < 60:
+        return '%.1fs' % duration
+    return '%dm%02ds' % divmod(int(duration), 60)
+
+
+class Plan(object):
+    """Ordered graph of the steps of a build.
+
+    Each step lists the commands it would run, or why it would be
+    skipped, and the steps it has to wait for. Steps that wait for the
+    same step can run in parallel.
+    """
+    def __init__(self, durations=None):
+        self.durations = durations or {}
+        self.steps = []
+
+    def add(self, name, commands=(), skip=None, after=None):
+        """Adds a step and returns its number.
+
+        By default, a step waits for the previous one.
+        """
+        if after is None:
+            after = self.steps and [len(self.steps)] or []
+        self.steps.append({'name': name, 'commands': list(commands),
+                           'skip': skip, 'after': list(after)})
+        return len(self.steps)
+
+    def cost(self, number):
+        """Returns the estimated duration of a step, or None if unknown."""
+        step = self.steps[number - 1]
+        if step['skip'] is not None:
+            return 0
+        return self.durations.get(step['name'])
+
+    def total(self):
+        """Returns the duration of the longest path, and the number of
+        steps that would run with an unknown duration."""
+        ends = []
+        unknown = 0
+        for number, step in enumerate(self.steps, 1):
+            cost = self.cost(number)
+            if cost is None:
+                unknown += 1
+                cost = 0
+            start = max([ends[after - 1] for after in step['after']] or [0])
+            ends.append(start + cost)
+        return max(ends or [0]), unknown
+
+    def display(self, stream=None):
+        if stream is None:
+            stream = sys.stdout
+        for number, step in enumerate(self.steps, 1):
+            after = ', '.join([str(after) for after in step['after']])
+            if step['skip'] is not None:
+                cost = 'skip'
+            else:
+                cost = _format_duration(self.cost(number))
+            stream.write('%3d. %-56s %8s   after: %s\n'
+                         % (number, step['name'], cost, after or '-'))
+            if step['skip'] is not None:
+                stream.write('       skipped: %s\n' % step['skip'])
+            for command in step['commands']:
+                stream.write('       $ %s\n' % command)
+
+        total, unknown = self.total()
+        running = len([step for step in self.steps if step['skip'] is None])
+        stream.write('\n%d steps, %d to run, estimated duration %s'
+                     % (len(self.steps), running, _format_duration(total)))
+        if unknown:
+            stream.write(' (%d steps never recorded)' % unknown)
+        stream.write('\n')
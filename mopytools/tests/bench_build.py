@@ -0,0 +1,317 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Hermetic benchmark of buildapp and buildrpms.
+
+Generates an app and its Services dependencies as local repositories,
+serves its external requirements from a local simple index, stubs
+pypi2rpm, pip and the setup.py commands, then times each phase of a
+buildapp and a buildrpms run.
+
+    $ python -m mopytools.tests.bench_build --deps 10 --tags 1000 \\
+        --packages 80 --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser, Values
+
+from mopytools import build_app, build_rpms, trace
+from mopytools.build import BuildSession
+from mopytools.tests.support import SimpleIndex
+
+
+# phases, by step name
+PHASES = [('get_environ_info', 'Checking the environ'),
+          ('updating_repo', 'Updating the repo'),
+          ('build_deps', 'Building Services dependencies'),
+          ('build_external_deps', 'Building External dependencies'),
+          ('build_core_app', 'Now building the app itself'),
+          ('build_core_rpm', "Building the project's RPM"),
+          ('build_deps_rpms', 'Building RPMS for internal deps'),
+          ('resolve_reqs', 'Resolving the requirements versions'),
+          ('build_external_deps_rpms', 'Building RPMS for external deps')]
+
+
+_SETUP = """\
+from setuptools import setup
+setup(name=%r, version='0.1')
+"""
+
+_SPEC = """\
+Name: %(name)s
+Url: http://example.com/%(name)s
+"""
+
+# stands for the Python interpreter running setup.py
+_PYTHON_STUB = """\
+#!/bin/sh
+case "$*" in
+  *develop*) exit 0;;
+  *bdist_rpm2*)
+    for arg in "$@"; do
+      case "$arg" in --dist-dir=*) dist="${arg#--dist-dir=}";; esac
+    done
+    touch "$dist/$(basename $(pwd)).rpm"
+    exit 0;;
+esac
+exec %s "$@"
+"""
+
+_PYPI2RPM_STUB = """\
+#!/bin/sh
+for arg in "$@"; do
+  case "$arg" in
+    --dist-dir=*) dist="${arg#--dist-dir=}";;
+    --version=*) version="${arg#--version=}";;
+  esac
+  project="$arg"
+done
+touch "$dist/python-$project-$version.rpm"
+"""
+
+_ENV = dict(os.environ, GIT_AUTHOR_NAME='bench',
+            GIT_AUTHOR_EMAIL='bench@example.com',
+            GIT_COMMITTER_NAME='bench',
+            GIT_COMMITTER_EMAIL='bench@example.com', HGUSER='bench')
+
+
+def _call(cmd, cwd, stdin=None):
+    sub = subprocess.Popen(cmd, shell=True, cwd=cwd, env=_ENV,
+                           stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+    output = sub.communicate(stdin)[0]
+    if sub.returncode != 0:
+        raise OSError('%r failed: %s' % (cmd, output))
+    return output
+
+
+def _write(path, content, mode=None):
+    with open(path, 'w') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+def create_repo(path, name, vcs='git', tags=10, commits=1, files=None):
+    """Creates a project repository with commits and rpm-* tags."""
+    os.makedirs(path)
+    _write(os.path.join(path, 'setup.py'), _SETUP % name)
+    for filename, content in (files or {}).items():
+        _write(os.path.join(path, filename), content)
+
+    if vcs == 'git':
+        _call('git init -q && git add -A && git commit -q -m init', path)
+        for index in range(commits - 1):
+            _call('git commit -q --allow-empty -m "commit %d"' % index, path)
+        head = _call('git rev-parse HEAD', path).strip()
+        refs = ''.join(['create refs/tags/rpm-0.%d %s\n' % (index, head)
+                        for index in range(tags)])
+        _call('git update-ref --stdin', path, refs)
+    else:
+        _call('hg init && hg add -q && hg commit -q -m init', path)
+        for index in range(commits - 1):
+            _write(os.path.join(path, 'CHANGES'), str(index))
+            _call('hg commit -q -A -m "commit %d"' % index, path)
+        tags = ''.join(['%s rpm-0.%d\n' % ('0' * 40, index)
+                        for index in range(tags)])
+        node = _call('hg id -i --debug', path).strip()
+        _write(os.path.join(path, '.hgtags'), tags.replace('0' * 40, node))
+        _call('hg commit -q -A -m tags', path)
+
+
+def create_workspace(root, deps=5, tags=10, commits=1, packages=20,
+                     vcs='git', channel='prod'):
+    """Creates the app and its deps under root. Returns the app location.
+    """
+    repos = os.path.join(root, 'repos')
+    dep_names = ['dep%d' % index for index in range(deps)]
+    for name in dep_names:
+        create_repo(os.path.join(repos, name), name, vcs, tags, commits)
+
+    # stage and prod requirements have to be pinned, in dev half of them
+    # are ranged, to hit the index
+    reqs = []
+    for index in range(packages):
+        if index % 2 and channel == 'dev':
+            reqs.append('package%d>=1.0' % index)
+        else:
+            reqs.append('package%d==1.0' % index)
+    reqs = '\n'.join(reqs) + '\n'
+
+    app = os.path.join(root, 'app')
+    create_repo(app, 'app', vcs, tags, commits,
+                files={'%s-reqs.txt' % channel: reqs,
+                       'app.spec': _SPEC % {'name': 'app'}})
+    return app, dep_names
+
+
+def _stub(root, name, content):
+    path = os.path.join(root, name)
+    _write(path, content, 0755)
+    return path
+
+
+def _phases(events):
+    durations = {}
+    for phase, step in PHASES:
+        spans = [event['dur'] for event in events if event['name'] == step]
+        if spans:
+            durations[phase] = sum(spans) / 1000000.
+    return durations
+
+
+def bench(deps=5, tags=10, commits=1, packages=20, vcs='git', jobs=1,
+          channel='prod'):
+    """Runs buildapp and buildrpms on a generated workspace.
+
+    Returns a dict with the parameters and the duration of each phase.
+    """
+    root = tempfile.mkdtemp()
+    packages_versions = dict(('package%d' % index, ['1.0', '1.1', '2.0b1'])
+                             for index in range(packages))
+    index = SimpleIndex(packages_versions).start()
+    location = os.getcwd()
+    old_stdout = sys.stdout
+    log = None
+    patched = [(build_app, 'PYTHON'), (build_app, 'PIP'),
+               (build_app, 'REPO_ROOT'), (build_rpms, 'PYTHON'),
+               (build_rpms, 'PYPI2RPM')]
+    old_values = [getattr(module, name) for module, name in patched]
+    try:
+        app, dep_names = create_workspace(root, deps, tags, commits,
+                                          packages, vcs, channel)
+        python = _stub(root, 'python', _PYTHON_STUB % sys.executable)
+        build_app.PYTHON = build_rpms.PYTHON = python
+        build_app.PIP = _stub(root, 'pip', '#!/bin/sh\nexit 0\n')
+        build_app.REPO_ROOT = os.path.join(root, 'repos') + os.sep
+        build_rpms.PYPI2RPM = _stub(root, 'pypi2rpm.py', _PYPI2RPM_STUB)
+
+        dist_dir = os.path.join(root, 'rpms')
+        os.mkdir(dist_dir)
+        options = Values({'dist_dir': dist_dir, 'force': False,
+                          'reinstall': False,
+                          'index': index.url, 'extras': None,
+                          'download_cache': None, 'jobs': jobs,
+                          'timeout': 300, 'verbose': False})
+
+        os.chdir(app)
+        log = sys.stdout = open(os.path.join(root, 'build.log'), 'w')
+        tracer = trace._TRACER = trace.Tracer()
+        start = time.time()
+        session = BuildSession(dep_names, channel)
+        build_app._buildapp(channel, dep_names, False, 300, False,
+                            index.url, None, None, jobs, session=session)
+        build_rpms._buildrpms(dep_names, channel, options, session)
+        total = time.time() - start
+    finally:
+        trace.stop_tracing()
+        if log is not None:
+            sys.stdout = old_stdout
+            log.close()
+        for (module, name), value in zip(patched, old_values):
+            setattr(module, name, value)
+        os.chdir(location)
+        index.stop()
+        shutil.rmtree(root)
+
+    return {'params': {'deps': deps, 'tags': tags, 'commits': commits,
+                       'packages': packages, 'vcs': vcs, 'jobs': jobs,
+                       'channel': channel},
+            'phases': _phases(tracer.events),
+            'total': total,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def print_results(results, previous=None):
+    print('%-28s %10s %10s %8s' % ('Phase', 'Duration', 'Previous',
+                                   'Change'))
+    phases = [phase for phase, step in PHASES] + ['total']
+    for phase in phases:
+        if phase == 'total':
+            duration = results['total']
+            before = previous and previous['total']
+        else:
+            duration = results['phases'].get(phase)
+            before = previous and previous['phases'].get(phase)
+        if duration is None:
+            continue
+        if before:
+            change = '%+7.1f%%' % ((duration - before) * 100. / before)
+            before = '%9.2fs' % before
+        else:
+            change = before = ''
+        print('%-28s %9.2fs %10s %8s' % (phase, duration, before, change))
+
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--deps', type='int', default=5,
+                      help='Number of Services dependencies')
+    parser.add_option('--tags', type='int', default=10,
+                      help='Number of rpm-* tags in each repository')
+    parser.add_option('--commits', type='int', default=1,
+                      help='Number of commits in each repository')
+    parser.add_option('--packages', type='int', default=20,
+                      help='Number of external requirements')
+    parser.add_option('--vcs', default='git', type='choice',
+                      choices=['git', 'hg'])
+    parser.add_option('-c', '--channel', default='prod', type='choice',
+                      choices=['prod', 'stage', 'dev'])
+    parser.add_option('-j', '--jobs', type='int', default=1)
+    parser.add_option('-o', '--output', help='Save the results in this file')
+    parser.add_option('--compare', help='Results of a previous run')
+    options, args = parser.parse_args()
+
+    results = bench(options.deps, options.tags, options.commits,
+                    options.packages, options.vcs, options.jobs,
+                    options.channel)
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" helpers shared by the tests
+"""
+import unittest
+import threading
+import os
+import hashlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+def _has_git():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(path, 'git')):
+            return True
+    return False
+
+
+def require_git():
+    """Skips the running test when git is not installed."""
+    if not _has_git():
+        raise unittest.SkipTest('git is not installed')
+
+
+_PAGE = """\
+<html><body>
+%s
+</body></html>
+"""
+
+_LINK = '<a href="../../packages/%s#md5=%s">%s</a><br/>'
+
+
+class _IndexHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        index = self.server.index
+        with index.lock:
+            index.requests.append(self.path)
+            index.connections.add(self.client_address)
+
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'simple' or \
+                parts[1] not in index.projects:
+            self._respond(404, 'Not found')
+            return
+
+        project = parts[1]
+        links = ['<a href="/">home</a>']
+        for version in index.projects[project]:
+            archive = '%s-%s.tar.gz' % (project, version)
+            links.append(_LINK % (archive, hashlib.md5(archive).hexdigest(),
+                                  archive))
+        content = _PAGE % '\n'.join(links)
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+
+        if self.headers.getheader('If-None-Match') == etag:
+            self._respond(304, '', etag)
+        else:
+            self._respond(200, content, etag)
+
+    def _respond(self, code, content, etag=None):
+        self.send_response(code)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SimpleIndex(object):
+    """A local stand-in for a PyPI simple index, running in a thread.
+
+    projects maps project names to the list of their versions.
+    """
+    def __init__(self, projects=None):
+        self.projects = projects or {}
+        self.requests = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _IndexHandler)
+        self._server.index = self
+        self.url = 'http://127.0.0.1:%d/simple/' % self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,303 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" benchmarks for mopytools
+
+Run with a bigger data set with:
+
+    $ python -m mopytools.tests.test_benchmarks
+"""
+import unittest
+import time
+import os
+import sys
+import subprocess
+
+from distutils2.version import (NormalizedVersion, IrrationalVersionError,
+                                suggest_normalized_version)
+from pkg_resources import parse_version
+
+from mopytools import util
+from mopytools.index import get_index_cache, set_index_cache
+from mopytools.tests.support import require_git
+
+
+def _synthetic_tags(count):
+    """Returns count rpm-* tags, finals and pre-releases mixed."""
+    suffixes = ['', 'rc1', 'b2', 'rc2', '-1']
+    tags = []
+    for index in range(count):
+        tags.append('%s%d.%d.%d%s' % (util.TAG_PREFIX, index // 1000,
+                                      (index // 10) % 100, index % 10,
+                                      suffixes[index % len(suffixes)]))
+    # the most recent tag is a pre-release
+    tags.append('%s%d.0rc1' % (util.TAG_PREFIX, count))
+    return tags
+
+
+def _legacy_channel_tag(tags, channel):
+    """The cmp-based sort and selection mopytools used to do."""
+    def _sort_version(version1, version2):
+        nv1 = suggest_normalized_version(version1)
+        nv2 = suggest_normalized_version(version2)
+        if nv1 is not None and nv2 is not None:
+            return cmp(nv1, nv2)
+        return cmp(parse_version(version1), parse_version(version2))
+
+    tags = list(tags)
+    tags.sort(cmp=_sort_version)
+    tags.reverse()
+
+    for tag in tags:
+        version = tag[len(util.TAG_PREFIX):].replace('-', '.')
+        try:
+            nv = NormalizedVersion(version)
+        except IrrationalVersionError:
+            continue
+        if channel != 'prod' or nv.is_final:
+            return tag
+
+
+def bench_channel_tags(count):
+    """Returns the legacy and current durations of the channel lookups."""
+    tags = _synthetic_tags(count)
+
+    start = time.time()
+    legacy = [_legacy_channel_tag(tags, channel)
+              for channel in ('prod', 'stage')]
+    legacy_duration = time.time() - start
+
+    start = time.time()
+    index = util.TagIndex(dict((tag, None) for tag in tags))
+    current = [index.get_channel_tag(channel)
+               for channel in ('prod', 'stage')]
+    duration = time.time() - start
+
+    assert legacy == current, (legacy, current)
+    return legacy_duration, duration
+
+
+def _legacy_best_release(versions, version, token):
+    """The cmp-based version matching mopytools used to do."""
+    _V = NormalizedVersion
+
+    def _vsort(version1, version2):
+        if _V(version1) > _V(version2):
+            return -1
+        elif _V(version1) < _V(version2):
+            return 1
+        return 0
+
+    ops = {'>=': lambda v1, v2: _V(v1) >= _V(v2),
+           '<': lambda v1, v2: _V(v1) < _V(v2)}
+    selected = [ver for ver in versions if ops[token](ver, version)]
+    selected.sort(_vsort)
+    return selected[0]
+
+
+class _FakeIndex(object):
+    def __init__(self, versions):
+        self.versions = versions
+
+    def get_versions(self, project, index_url=None):
+        return list(self.versions)
+
+
+def bench_best_release(count, lookups=20):
+    """Returns the legacy and current durations of ranged lookups among
+    count releases."""
+    versions = ['%d.%d.%d' % (index // 100, (index // 10) % 10, index % 10)
+                for index in range(count)]
+    ranges = [('>=', '0.5'), ('<', versions[count // 2])] * (lookups // 2)
+
+    start = time.time()
+    legacy = [_legacy_best_release(versions, version, token)
+              for token, version in ranges]
+    legacy_duration = time.time() - start
+
+    old_cache = get_index_cache()
+    set_index_cache(_FakeIndex(versions))
+    for func in (util.normalized_version, util.suggested_version,
+                 util.legacy_version):
+        func.cache.clear()
+    try:
+        start = time.time()
+        current = [util._best_release('foo', version, token)
+                   for token, version in ranges]
+        duration = time.time() - start
+    finally:
+        set_index_cache(old_cache)
+
+    assert legacy == current, (legacy, current)
+    return legacy_duration, duration
+
+
+# the modules the scripts only import when a build needs them
+_LAZY_MODULES = ('distutils2.index.simple', 'pkg_resources', 'pip.req')
+
+_STARTUP = """\
+import sys
+import time
+start = time.time()
+import mopytools.build_app, mopytools.build_rpms
+startup = time.time() - start
+loaded = [name for name in %(modules)r if name in sys.modules]
+start = time.time()
+for name in %(modules)r:
+    __import__(name)
+print('%%f %%f %%s' %% (startup, time.time() - start, ','.join(loaded)))
+"""
+
+
+def bench_startup(runs=3):
+    """Returns the best durations of importing the scripts and of importing
+    the lazy modules afterwards, in fresh interpreters, and the lazy
+    modules the scripts imported anyway."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    code = _STARTUP % {'modules': _LAZY_MODULES}
+    startups, lazy = [], []
+    for run in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env)
+        startup, duration, loaded = output.split(' ')
+        startups.append(float(startup))
+        lazy.append(float(duration))
+    loaded = [name for name in loaded.strip().split(',') if name]
+    return min(startups), min(lazy), loaded
+
+
+class TestBenchmarks(unittest.TestCase):
+    # the durations depend on the load of the host: the tests count how
+    # many times the versions are parsed instead
+
+    def setUp(self):
+        self.parses = 0
+        self.old_parse = NormalizedVersion._parse
+
+        def _parse(version, *args, **kw):
+            self.parses += 1
+            return self.old_parse(version, *args, **kw)
+
+        NormalizedVersion._parse = _parse
+        for func in (util.normalized_version, util.suggested_version,
+                     util.legacy_version):
+            func.cache.clear()
+
+    def tearDown(self):
+        NormalizedVersion._parse = self.old_parse
+
+    def test_channel_tags(self):
+        tags = _synthetic_tags(2000)
+        expected = [_legacy_channel_tag(tags, channel)
+                    for channel in ('prod', 'stage')]
+        self.parses = 0
+
+        # each tag is parsed at most once
+        index = util.TagIndex(dict((tag, None) for tag in tags))
+        self.assertEqual([index.get_channel_tag(channel)
+                          for channel in ('prod', 'stage')], expected)
+        self.assertTrue(self.parses <= len(tags), self.parses)
+
+        # and never again, whatever the number of lookups
+        self.parses = 0
+        for i in range(10):
+            index = util.TagIndex(dict((tag, None) for tag in tags))
+            for channel in ('prod', 'stage'):
+                index.get_channel_tag(channel)
+        self.assertEqual(self.parses, 0)
+
+    def test_best_release(self):
+        versions = ['%d.%d.%d' % (index // 100, (index // 10) % 10,
+                                  index % 10) for index in range(300)]
+        ranges = [('>=', '0.5'), ('<', versions[150])] * 10
+        old_cache = get_index_cache()
+        set_index_cache(_FakeIndex(versions))
+        try:
+            for token, version in ranges:
+                self.assertEqual(util._best_release('foo', version, token),
+                                 _legacy_best_release(versions, version,
+                                                      token))
+            self.parses = 0
+            for func in (util.normalized_version, util.suggested_version):
+                func.cache.clear()
+
+            # each release is parsed once, not at each comparison
+            for token, version in ranges:
+                util._best_release('foo', version, token)
+        finally:
+            set_index_cache(old_cache)
+        self.assertTrue(self.parses <= len(versions) + len(ranges),
+                        self.parses)
+
+    def test_build_bench(self):
+        require_git()
+        from mopytools.tests.bench_build import bench, PHASES
+        results = bench(deps=2, tags=5, packages=4)
+        self.assertEqual(sorted(results['phases']),
+                         sorted(phase for phase, step in PHASES))
+
+    def test_startup(self):
+        # starting buildapp or buildrpms costs less than the imports it
+        # leaves to the code paths needing them
+        startup, lazy, loaded = bench_startup()
+        self.assertEqual(loaded, [])
+        self.assertTrue(startup < lazy, (startup, lazy))
+
+    def test_versions_cache_is_bounded(self):
+        cache = util.normalized_version.cache
+        for index in range(util._VERSIONS_CACHE_SIZE + 10):
+            util.normalized_version('0.%d' % index)
+        self.assertEqual(len(cache), util._VERSIONS_CACHE_SIZE)
+        self.assertTrue('0.0' not in cache)
+
+
+if __name__ == '__main__':
+    count = int(os.environ.get('MOPYTOOLS_BENCH_TAGS', 50000))
+    legacy, current = bench_channel_tags(count)
+    print('Channel tags lookup for %d tags' % count)
+    print('    cmp-based sort:  %.2fs' % legacy)
+    print('    single pass:     %.2fs' % current)
+
+    count = int(os.environ.get('MOPYTOOLS_BENCH_RELEASES', 1000))
+    legacy, current = bench_best_release(count)
+    print('Ranged lookups among %d releases' % count)
+    print('    cmp-based sort:  %.2fs' % legacy)
+    print('    parsed once:     %.2fs' % current)
+
+    startup, lazy, loaded = bench_startup()
+    print('Scripts startup')
+    print('    imports:         %.3fs' % startup)
+    print('    lazy imports:    %.3fs' % lazy)
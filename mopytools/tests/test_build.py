@@ -41,10 +41,12 @@ import StringIO
 import ConfigParser
 import sys
 import tempfile
+import shutil
+import time
 import os
 
 from mopytools.util import get_channel_tag, tag_exists, get_options
-from mopytools import util
+from mopytools import util, build
 
 
 _CMDS = {"hg tags": """\
@@ -95,6 +97,14 @@ class ParserNoWrite(ConfigParser.ConfigParser):
         self.writes.append((cfg, stream.read()))
 
 
+def _write_ref(git_dir, ref, sha):
+    path = os.path.join(git_dir, *ref.split('/'))
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(sha + '\n')
+
+
 class TestBuild(unittest.TestCase):
 
     def setUp(self):
@@ -103,7 +113,19 @@ class TestBuild(unittest.TestCase):
         self.old_cp = util.ConfigParser
         util.ConfigParser = ParserNoWrite
 
+        # a fake git repository
+        self.old_dir = os.getcwd()
+        self.repo = tempfile.mkdtemp()
+        self.git_dir = os.path.join(self.repo, '.git')
+        for index, tag in enumerate(_CMDS['git tag'].split()):
+            _write_ref(self.git_dir, 'refs/tags/' + tag, '%040d' % index)
+        for branch in ('master', 'feature'):
+            _write_ref(self.git_dir, 'refs/heads/' + branch, '1' * 40)
+        os.chdir(self.repo)
+
     def tearDown(self):
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.repo)
         subprocess.Popen = self.old_po
         util.ConfigParser = self.old_cp
 
@@ -122,6 +144,41 @@ class TestBuild(unittest.TestCase):
         self.assertTrue(tag_exists('rpm-0.5rc1'))
         self.assertFalse(tag_exists('xxx'))
 
+    def test_packed_refs(self):
+        shutil.rmtree(os.path.join(self.git_dir, 'refs', 'tags'))
+        with open(os.path.join(self.git_dir, 'packed-refs'), 'w') as f:
+            f.write('# pack-refs with: peeled fully-peeled\n')
+            f.write('%s refs/tags/rpm-0.6\n' % ('a' * 40))
+            f.write('^%s\n' % ('b' * 40))
+            f.write('%s refs/tags/rpm-0.5\n' % ('c' * 40))
+            f.write('%s refs/remotes/origin/rpm-0.7\n' % ('d' * 40))
+
+        index = util.get_tag_index()
+        self.assertEqual(index.get_tags(), ['rpm-0.6', 'rpm-0.5'])
+        self.assertEqual(index.refs['rpm-0.6'], 'b' * 40)
+        self.assertEqual(index.refs['rpm-0.5'], 'c' * 40)
+        self.assertEqual(get_channel_tag('prod'), 'rpm-0.6')
+
+    def test_tag_index_cache(self):
+        index = util.get_tag_index()
+        self.assertTrue(util.get_tag_index() is index)
+
+        # adding a tag invalidates the index
+        _write_ref(self.git_dir, 'refs/tags/rpm-0.6', 'e' * 40)
+        tags_dir = os.path.join(self.git_dir, 'refs', 'tags')
+        os.utime(tags_dir, (time.time() + 10, time.time() + 10))
+        self.assertFalse(util.get_tag_index() is index)
+        self.assertEqual(get_channel_tag('prod'), 'rpm-0.6')
+
+    def test_hg_tags(self):
+        shutil.rmtree(self.git_dir)
+        self.assertEqual(get_channel_tag('dev'), 'default')
+        self.assertEqual(get_channel_tag('prod'), 'rpm-0.4')
+        self.assertEqual(get_channel_tag('stage'), 'rpm-0.5rc1')
+        self.assertTrue('feature' in util._get_tags(prefix=''))
+        self.assertEqual(util.get_tag_index().refs['rpm-0.4'],
+                         'c56849d09a4c')
+
     def test_distutils_setup(self):
         old_argv = sys.argv[:]
         sys.argv[:] = ['whatever', 'is_done']
@@ -133,13 +190,24 @@ class TestBuild(unittest.TestCase):
         result = ParserNoWrite.writes[-1][1]
         self.assertEquals(result, _CFG)
 
+    def test_reinstall(self):
+        # --reinstall does not force the checkouts
+        old_argv = sys.argv[:]
+        sys.argv[:] = ['', '--reinstall']
+        try:
+            options, args = get_options()
+        finally:
+            sys.argv[:] = old_argv
+        self.assertTrue(options.reinstall)
+        self.assertFalse(options.force)
+
     def test_rmdir(self):
         from mopytools import build_rpms
 
-        old_build_app = build_rpms.build_app
-        build_rpms.build_app = lambda: None
+        old_build_app = build_rpms.buildapp_session
+        build_rpms.buildapp_session = lambda session, options: None
         old_buildrpms = build_rpms._buildrpms
-        build_rpms._buildrpms = lambda deps, channel, options: None
+        build_rpms._buildrpms = lambda deps, channel, options, session: None
         old_argv = sys.argv[:]
 
         tempdir = tempfile.mkdtemp()
@@ -153,7 +221,7 @@ class TestBuild(unittest.TestCase):
             build_rpms.main()
         finally:
             sys.argv[:] = old_argv
-            build_rpms.build_app = old_build_app
+            build_rpms.buildapp_session = old_build_app
             build_rpms._buildrpms = old_buildrpms
             sys.stdout = old_stdout
 
@@ -181,3 +249,69 @@ class TestBuild(unittest.TestCase):
         unpinned.sort()
         self.assertEqual(unpinned,
                          ['Paste', 'translationstring', 'wsgi-intercept'])
+
+
+class TestBuildSession(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.old = (build.has_changes, build.updating_repo,
+                    build.get_environ_info, build.get_revision)
+
+        def _has_changes(*args):
+            self.calls.append(('has_changes', os.getcwd()))
+            return False
+
+        def _updating_repo(*args):
+            self.calls.append(('updating_repo', args[-1]))
+
+        def _get_environ_info(deps):
+            self.calls.append(('get_environ_info', deps))
+            return 'app', False
+
+        def _get_revision():
+            self.calls.append(('get_revision', os.getcwd()))
+            return 'abc'
+
+        build.get_revision = _get_revision
+        build.has_changes = _has_changes
+        build.updating_repo = _updating_repo
+        build.get_environ_info = _get_environ_info
+        self.old_dir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        (build.has_changes, build.updating_repo, build.get_environ_info,
+         build.get_revision) = self.old
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def test_once(self):
+        os.chdir(self.tempdir)
+        session = build.BuildSession(['dep'], 'prod')
+        for i in range(2):
+            self.assertEqual(session.get_environ_info(), ('app', False))
+            self.assertEqual(session.name, 'app')
+            session.update_repo()
+            self.assertFalse(session.has_changes())
+
+        # the repo is looked at again once updated
+        self.assertEqual(self.calls,
+                         [('get_environ_info', ['dep']),
+                          ('has_changes', os.getcwd()),
+                          ('updating_repo', False),
+                          ('has_changes', os.getcwd())])
+
+        # each checkout is looked at once
+        os.mkdir('dep')
+        os.chdir('dep')
+        session.has_changes()
+        session.has_changes()
+        self.assertEqual(self.calls[-1], ('has_changes', os.getcwd()))
+        self.assertEqual(len(self.calls), 5)
+
+        # and so is its revision
+        self.assertEqual(session.get_revision(), 'abc')
+        self.assertEqual(session.get_revision(), 'abc')
+        self.assertEqual(self.calls[-1], ('get_revision', os.getcwd()))
+        self.assertEqual(len(self.calls), 6)
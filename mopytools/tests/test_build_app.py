@@ -0,0 +1,214 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" tests for mopytools.build_app
+"""
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+import StringIO
+
+from mopytools import build_app
+from mopytools.tests.bench_build import create_repo, _call
+from mopytools.tests.support import require_git
+
+
+class TestBuildDep(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        self.remote = os.path.join(self.tempdir, 'repos', 'dep')
+        self.deps_dir = os.path.join(self.tempdir, 'deps')
+        os.mkdir(self.deps_dir)
+
+        self.commands = []
+        self.old_run = build_app.run
+
+        def _run(cmd, *args, **kw):
+            self.commands.append(cmd.split()[:2])
+            return self.old_run(cmd, *args, **kw)
+
+        build_app.run = _run
+        self.old_root = build_app.REPO_ROOT
+        build_app.REPO_ROOT = os.path.dirname(self.remote) + os.sep
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        build_app.run = self.old_run
+        build_app.REPO_ROOT = self.old_root
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def _checkout(self, channel='prod', specific_tags=False, **kw):
+        self.commands = []
+        try:
+            build_app.checkout_dep('dep', self.deps_dir, channel,
+                                   specific_tags, **kw)
+        finally:
+            os.chdir(self.old_dir)
+        return self.commands
+
+    def test_up_to_date(self):
+        require_git()
+        create_repo(self.remote, 'dep', tags=2)
+        _call('git tag -a rpm-0.2 -m "annotated"', self.remote)
+
+        self.assertEqual(self._checkout(),
+                         [['git', 'clone'], ['git', 'checkout']])
+
+        # the checkout is at the latest tag, nothing to fetch
+        self.assertEqual(self._checkout(), [])
+
+        # a new tag, fetching it
+        _call('git commit -q --allow-empty -m new && git tag rpm-0.3',
+              self.remote)
+        self.assertEqual(self._checkout(),
+                         [['git', 'fetch'], ['git', 'checkout']])
+        self.assertEqual(self._checkout(), [])
+
+        # the dev channel always fetches
+        self.assertEqual(self._checkout('dev'),
+                         [['git', 'fetch'], ['git', 'checkout']])
+
+    def test_parallel_dirty(self):
+        require_git()
+        create_repo(self.remote, 'dep', tags=2)
+        create_repo(os.path.join(self.tempdir, 'repos', 'other'), 'other',
+                    tags=2)
+        self._checkout()
+        with open(os.path.join(self.deps_dir, 'dep', 'setup.py'), 'a') as f:
+            f.write('# changed\n')
+
+        # the local changes stop the build, like in the serial path
+        try:
+            build_app.checkout_deps(['dep', 'other'], self.deps_dir,
+                                    jobs=2)
+        except SystemExit:
+            pass
+        else:
+            raise AssertionError('The build went on')
+        finally:
+            os.chdir(self.old_dir)
+        self.assertTrue('dep (' in sys.stdout.getvalue())
+        self.assertTrue('aborted' in sys.stdout.getvalue())
+
+    def test_specific_tag(self):
+        require_git()
+        create_repo(self.remote, 'dep', tags=3)
+        os.environ['DEP'] = 'rpm-0.1'
+        try:
+            self._checkout(specific_tags=True)
+            self.assertEqual(self._checkout(specific_tags=True), [])
+        finally:
+            del os.environ['DEP']
+
+    def _head(self):
+        dep = os.path.join(self.deps_dir, 'dep')
+        return _call('git rev-parse HEAD', dep).strip()
+
+    def _tag(self, tag):
+        return _call('git rev-parse %s^{commit}' % tag, self.remote).strip()
+
+    def test_mirror(self):
+        require_git()
+        create_repo(self.remote, 'dep', tags=2)
+        mirrors = os.path.join(self.tempdir, 'mirrors')
+
+        self.assertEqual(self._checkout(mirror_dir=mirrors),
+                         [['git', 'clone'], ['git', 'clone'],
+                          ['git', 'checkout']])
+        mirror, = os.listdir(mirrors)
+        self.assertTrue(mirror.startswith('dep-'))
+
+        # the workspace borrows the objects of the mirror
+        alternates = os.path.join(self.deps_dir, 'dep', '.git', 'objects',
+                                  'info', 'alternates')
+        self.assertTrue(os.path.exists(alternates))
+
+        # a new tag goes through the mirror
+        _call('git commit -q --allow-empty -m new && git tag rpm-0.3',
+              self.remote)
+        self.assertEqual(self._checkout(mirror_dir=mirrors),
+                         [['git', '--git-dir=%s' % os.path.join(mirrors,
+                                                                 mirror)],
+                          ['git', 'fetch'], ['git', 'checkout']])
+        self.assertEqual(self._head(), self._tag('rpm-0.3'))
+
+        # a second workspace reuses the mirror
+        shutil.rmtree(os.path.join(self.deps_dir, 'dep'))
+        commands = self._checkout(mirror_dir=mirrors)
+        self.assertEqual(commands[0][:1], ['git'])
+        self.assertTrue(commands[0][1].startswith('--git-dir'))
+        self.assertEqual(os.listdir(mirrors), [mirror])
+
+    def test_shallow(self):
+        require_git()
+        create_repo(self.remote, 'dep', tags=3, commits=2)
+        mirrors = os.path.join(self.tempdir, 'mirrors')
+
+        self._checkout(mirror_dir=mirrors, shallow=True)
+        dep = os.path.join(self.deps_dir, 'dep')
+        self.assertEqual(_call('git rev-list --count HEAD', dep).strip(), '1')
+        self.assertEqual(self._head(), self._tag('rpm-0.2'))
+
+        _call('git commit -q --allow-empty -m new && git tag rpm-0.3',
+              self.remote)
+        self._checkout(mirror_dir=mirrors, shallow=True)
+        self.assertEqual(self._head(), self._tag('rpm-0.3'))
+
+    def test_shallow_dev(self):
+        require_git()
+        create_repo(self.remote, 'dep', tags=1)
+        self._checkout('dev', shallow=True)
+        self.assertEqual(self._head(), self._tag('master'))
+
+        # master is checked out, and fetched again
+        _call('git commit -q --allow-empty -m new', self.remote)
+        self._checkout('dev', shallow=True)
+        self.assertEqual(self._head(), self._tag('master'))
+
+    def test_shallow_without_tag(self):
+        require_git()
+        create_repo(self.remote, 'dep', tags=1, commits=2)
+        # no specific tag to fetch, the whole repository is cloned
+        self._checkout(specific_tags=True, shallow=True)
+        dep = os.path.join(self.deps_dir, 'dep')
+        self.assertNotEqual(_call('git rev-list --count HEAD', dep).strip(),
+                            '1')
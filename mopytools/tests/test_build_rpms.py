@@ -0,0 +1,425 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" tests for mopytools.build_rpms
+"""
+import unittest
+import tempfile
+import shutil
+import time
+import sys
+import os
+import socket
+import tarfile
+import threading
+import StringIO
+
+from mopytools import build_rpms, distributed
+from mopytools.build import BuildSession
+from mopytools.util import timeout
+from mopytools.plan import get_durations
+from mopytools.tests.bench_build import create_workspace, _call
+from mopytools.tests.support import require_git
+
+
+# fake pypi2rpm.py, creates an empty rpm in --dist-dir
+_PYPI2RPM = """\
+import sys
+import os
+
+args = dict(arg[2:].split('=', 1) for arg in sys.argv[1:-1])
+project = sys.argv[-1]
+if project == 'boom':
+    sys.exit(2)
+name = 'python27-%s-%s.rpm' % (project, args.get('version', 'last'))
+open(os.path.join(args['dist-dir'], name), 'w').close()
+"""
+
+
+class Options(object):
+    index = 'http://pypi.example.com/simple'
+    download_cache = None
+    jobs = 3
+
+    def __init__(self, dist_dir):
+        self.dist_dir = dist_dir
+
+
+class TestBuildRPMS(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dist_dir = os.path.join(self.tempdir, 'rpms')
+        os.mkdir(self.dist_dir)
+        script = os.path.join(self.tempdir, 'pypi2rpm.py')
+        with open(script, 'w') as f:
+            f.write(_PYPI2RPM)
+        self.old_pypi2rpm = build_rpms.PYPI2RPM
+        build_rpms.PYPI2RPM = '%s %s' % (sys.executable, script)
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        build_rpms.PYPI2RPM = self.old_pypi2rpm
+        shutil.rmtree(self.tempdir)
+
+    def test_parallel_builds(self):
+        reqs = [('foo', '1.0'), ('bar', '2.1'), ('baz', None)]
+        options = Options(self.dist_dir)
+        durations = build_rpms.build_rpms(reqs=reqs, count=3, jobs=3,
+                                          options=options)
+        self.assertEqual(sorted(res[:2] for res in durations), sorted(reqs))
+        # kept for --plan
+        self.assertTrue('Building foo at version 1.0' in get_durations())
+        self.assertEqual(sorted(os.listdir(self.dist_dir)),
+                         ['python27-bar-2.1.rpm', 'python27-baz-last.rpm',
+                          'python27-foo-1.0.rpm'])
+
+    def test_parallel_builds_failure(self):
+        reqs = [('foo', '1.0'), ('boom', '1.0')]
+        options = Options(self.dist_dir)
+        self.assertRaises(SystemExit, build_rpms.build_rpms, reqs=reqs,
+                          count=2, jobs=2, options=options)
+        self.assertTrue('boom' not in ''.join(os.listdir(self.dist_dir)))
+
+    def test_rpm_cache(self):
+        cache = build_rpms.RPMCache(os.path.join(self.tempdir, 'cache'))
+        options = Options(self.dist_dir)
+        reqs = [('foo', '1.0'), ('bar', '2.1')]
+        build_rpms.build_rpms(reqs=reqs, count=2, jobs=2, options=options,
+                              cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+        # second run, pypi2rpm is not called anymore
+        shutil.rmtree(self.dist_dir)
+        os.mkdir(self.dist_dir)
+        build_rpms.PYPI2RPM = 'false'
+        build_rpms.build_rpms(reqs=reqs, count=2, jobs=2, options=options,
+                              cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(sorted(os.listdir(self.dist_dir)),
+                         ['python27-bar-2.1.rpm', 'python27-foo-1.0.rpm'])
+
+    def test_rpm_cache_eviction(self):
+        cache = build_rpms.RPMCache(os.path.join(self.tempdir, 'cache'),
+                                    max_size=15)
+        for name in ('old', 'new'):
+            path = os.path.join(self.tempdir, name + '.rpm')
+            with open(path, 'w') as f:
+                f.write('x' * 10)
+            key = cache.key(name, '1.0')
+            cache.put(key, [path])
+            entry = os.path.join(cache.path, key)
+            if name == 'old':
+                os.utime(entry, (0, 0))
+
+        self.assertEqual(cache.get(cache.key('old', '1.0'), self.dist_dir),
+                         None)
+        self.assertEqual(cache.get(cache.key('new', '1.0'), self.dist_dir),
+                         ['new.rpm'])
+
+    def test_no_name(self):
+        old_dir = os.getcwd()
+        os.chdir(self.dist_dir)
+        try:
+            self.assertRaises(IOError, build_rpms._setup_rpm_args)
+        finally:
+            os.chdir(old_dir)
+
+    def test_archive_virtualenv(self):
+        app = os.path.join(self.tempdir, 'app')
+        for path in ('bin', 'lib', 'include', 'local', 'app', 'deps'):
+            os.makedirs(os.path.join(app, path))
+        for path in ('setup.py', 'app/__init__.py', 'bin/python'):
+            with open(os.path.join(app, path), 'w') as f:
+                f.write('#')
+
+        def _names():
+            archive = build_rpms._archive(app)
+            archive.seek(0)
+            tar = tarfile.open(fileobj=archive)
+            try:
+                return sorted(tar.getnames())
+            finally:
+                tar.close()
+                archive.close()
+
+        self.assertEqual(_names(), ['.', './app', './app/__init__.py',
+                                    './bin', './bin/python', './include',
+                                    './lib', './local', './setup.py'])
+
+        # the checkout is a virtualenv
+        with open(os.path.join(app, 'bin', 'activate'), 'w') as f:
+            f.write('#')
+        self.assertEqual(_names(), ['.', './app', './app/__init__.py',
+                                    './setup.py'])
+
+    def test_resume(self):
+        old_dir = os.getcwd()
+        os.chdir(self.tempdir)
+        options = Options(self.dist_dir)
+        options.jobs = 1
+        try:
+            with open('prod-reqs.txt', 'w') as f:
+                f.write('foo==1.0\nboom==1.0\nbar==2.1\n')
+            journal = build_rpms.Journal(self.dist_dir)
+            self.assertRaises(SystemExit, build_rpms.build_external_deps_rpms,
+                              'prod', options, journal)
+            self.assertEqual(sorted(os.listdir(self.dist_dir)),
+                             ['.mopytools-journal', 'python27-foo-1.0.rpm'])
+
+            # foo is not built again
+            with open('prod-reqs.txt', 'w') as f:
+                f.write('foo==1.0\nbar==2.1\n')
+            journal = build_rpms.Journal(self.dist_dir, resume=True)
+            build_rpms.build_external_deps_rpms('prod', options, journal)
+            self.assertEqual(journal.skipped, 1)
+            self.assertEqual(len(os.listdir(self.dist_dir)), 3)
+
+            # unless its RPM is gone
+            os.remove(os.path.join(self.dist_dir, 'python27-foo-1.0.rpm'))
+            journal = build_rpms.Journal(self.dist_dir, resume=True)
+            bar = build_rpms._rpm_key('bar', '2.1', options.index)
+            self.assertTrue(journal.is_done('bar==2.1', bar))
+            foo = build_rpms._rpm_key('foo', '1.0', options.index)
+            self.assertFalse(journal.is_done('foo==1.0', foo))
+
+            # without --resume, the journal starts over
+            journal = build_rpms.Journal(self.dist_dir)
+            self.assertEqual(journal.units, {})
+        finally:
+            os.chdir(old_dir)
+
+    def test_overlap(self):
+        # the external deps are built while the internal RPMS are
+        class Session(object):
+            def get_environ_info(self):
+                return 'app', False
+
+            def update_repo(self):
+                pass
+
+        def build_internal(*args):
+            time.sleep(.5)
+            print('internal done')
+
+        old_dir = os.getcwd()
+        os.chdir(self.tempdir)
+        old_core = build_rpms.build_core_rpm
+        old_deps = build_rpms.build_deps_rpms
+        build_rpms.build_core_rpm = build_internal
+        build_rpms.build_deps_rpms = build_internal
+        options = Options(self.dist_dir)
+        try:
+            with open('prod-reqs.txt', 'w') as f:
+                f.write('foo==1.0\nbar==2.1\n')
+            build_rpms._buildrpms([], 'prod', options, Session())
+            output = sys.stdout.getvalue()
+            self.assertTrue('--- RPMS for external deps' in output)
+            self.assertTrue(output.index('internal done') <
+                            output.index('--- RPMS for external deps'))
+            self.assertEqual(len(os.listdir(self.dist_dir)), 3)
+
+            # a failure of the external deps is reported once the internal
+            # RPMS are built
+            with open('prod-reqs.txt', 'w') as f:
+                f.write('boom==1.0\n')
+            try:
+                build_rpms._buildrpms([], 'prod', options, Session())
+            except SystemExit, e:
+                self.assertTrue(e.code != 0)
+            else:
+                raise AssertionError('should fail')
+            self.assertTrue(': failed with code' in sys.stdout.getvalue())
+        finally:
+            build_rpms.build_core_rpm = old_core
+            build_rpms.build_deps_rpms = old_deps
+            os.chdir(old_dir)
+
+# fake interpreter running setup.py bdist_rpm2 in the worker scratch dirs
+_PYTHON = """\
+#!/bin/sh
+for arg in "$@"; do
+  case "$arg" in
+    --dist-dir=*) dist="${arg#--dist-dir=}";;
+    --spec-file=*) name="${arg#--spec-file=}";;
+    --name=*) name="${arg#--name=}";;
+  esac
+done
+test -f setup.py || exit 3
+touch "$dist/$name.rpm"
+"""
+
+
+def _free_address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+    return address
+
+
+class TestDistributed(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_dir = os.getcwd()
+        self.old_values = build_rpms.PYTHON, build_rpms.PYPI2RPM
+        script = os.path.join(self.tempdir, 'pypi2rpm.py')
+        with open(script, 'w') as f:
+            f.write(_PYPI2RPM)
+        build_rpms.PYPI2RPM = '%s %s' % (sys.executable, script)
+        build_rpms.PYTHON = os.path.join(self.tempdir, 'python')
+        with open(build_rpms.PYTHON, 'w') as f:
+            f.write(_PYTHON)
+        os.chmod(build_rpms.PYTHON, 0755)
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        build_rpms.PYTHON, build_rpms.PYPI2RPM = self.old_values
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def _build(self, packages=3, workers=2, reqs=None):
+        app, deps = create_workspace(self.tempdir, deps=2, tags=2,
+                                     packages=packages)
+        if reqs is not None:
+            with open(os.path.join(app, 'prod-reqs.txt'), 'w') as f:
+                f.write(reqs)
+            _call('git commit -q -a -m reqs', app)
+        os.mkdir(os.path.join(app, 'deps'))
+        for dep in deps:
+            _call('git clone -q %s deps/%s'
+                  % (os.path.join(self.tempdir, 'repos', dep), dep), app)
+        os.chdir(app)
+
+        options = Options(os.path.join(app, 'rpms'))
+        os.mkdir(options.dist_dir)
+        options.coordinator = _free_address()
+        options.force = False
+        options.timeout = 300
+
+        worker_options = Options(None)
+        worker_options.timeout = 300
+        threads = [threading.Thread(target=distributed.work,
+                                    args=(options.coordinator,
+                                          build_rpms._Builder(
+                                              worker_options).build))
+                   for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            build_rpms.coordinate(BuildSession(deps, 'prod'), options)
+        finally:
+            for thread in threads:
+                thread.join()
+        return sorted(os.listdir(options.dist_dir))
+
+    def test_workers(self):
+        require_git()
+        self.assertEqual(self._build(),
+                         ['app.spec.rpm',
+                          'python27-dep0.rpm',
+                          'python27-dep1.rpm',
+                          'python27-package0-1.0.rpm',
+                          'python27-package1-1.0.rpm',
+                          'python27-package2-1.0.rpm'])
+
+    def _serve(self, build, idle=60.):
+        coordinator = distributed.Coordinator(
+            [{'id': 1, 'name': 'slow'}], _free_address(), self.tempdir,
+            idle=idle)
+        worker = threading.Thread(target=distributed.work,
+                                  args=(coordinator.address, build))
+        worker.start()
+        try:
+            coordinator.serve()
+        finally:
+            worker.join()
+        return coordinator
+
+    def test_long_jobs(self):
+        # the scripts set a default socket timeout, shorter than builds
+        def _build(job, stream):
+            time.sleep(4.5)
+            return 0, 'built', []
+
+        coordinator = timeout(4.0)(self._serve)(_build)
+        self.assertEqual(coordinator.error, None)
+        self.assertEqual(coordinator.results[1]['output'], 'built')
+
+    def test_worker_started_first(self):
+        address = _free_address()
+        worker = threading.Thread(target=distributed.work,
+                                  args=(address,
+                                        lambda job, stream: (0, 'ok', [])))
+        worker.start()
+        try:
+            # the coordinator runs buildapp before listening
+            time.sleep(1)
+            coordinator = distributed.Coordinator(
+                [{'id': 1, 'name': 'job'}], address, self.tempdir)
+            coordinator.serve()
+        finally:
+            worker.join()
+        self.assertEqual(coordinator.results[1]['output'], 'ok')
+
+    def test_no_workers_left(self):
+        coordinator = distributed.Coordinator(
+            [{'id': 1, 'name': 'slow'}], _free_address(), self.tempdir,
+            idle=0.2)
+        # a worker going away in the middle of its job
+        sock = socket.create_connection(
+            distributed.parse_address(coordinator.address))
+        stream = sock.makefile('wb')
+        distributed.send(stream, {'op': 'get'})
+        stream.close()
+        sock.close()
+
+        coordinator.serve()
+        self.assertEqual(coordinator.results, {})
+        self.assertTrue(coordinator.error.startswith('No workers left'))
+
+    def test_failure(self):
+        require_git()
+        try:
+            self._build(reqs='package0==1.0\nboom==1.0\n', workers=1)
+        except SystemExit, e:
+            self.assertEqual(e.code, 2)
+        else:
+            raise AssertionError('The build did not fail')
@@ -0,0 +1,125 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" tests for mopytools.index
+"""
+import unittest
+import tempfile
+import shutil
+import httplib
+import StringIO
+import sys
+
+from mopytools.index import IndexCache
+from mopytools.tests.support import SimpleIndex
+
+
+class TestIndexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index = SimpleIndex({'foo': ['1.0', '1.1', '2.0b1']}).start()
+
+    def tearDown(self):
+        self.index.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_versions(self):
+        cache = IndexCache()
+        self.assertEqual(cache.get_versions('foo', self.index.url),
+                         ['1.0', '1.1', '2.0b1'])
+
+    def test_ttl(self):
+        cache = IndexCache(self.tempdir, ttl=3600)
+        cache.get_versions('foo', self.index.url)
+        cache.get_versions('foo', self.index.url)
+        self.assertEqual(len(self.index.requests), 1)
+
+        # another run reads the entry from the disk
+        cache = IndexCache(self.tempdir, ttl=3600)
+        self.assertEqual(cache.get_versions('foo', self.index.url),
+                         ['1.0', '1.1', '2.0b1'])
+        self.assertEqual(len(self.index.requests), 1)
+
+    def test_revalidation(self):
+        cache = IndexCache(self.tempdir, ttl=0)
+        cache.get_versions('foo', self.index.url)
+        cache.get_versions('foo', self.index.url)
+        self.assertEqual(len(self.index.requests), 2)
+
+        # the page changed
+        self.index.projects['foo'].append('2.0')
+        self.assertEqual(cache.get_versions('foo', self.index.url),
+                         ['1.0', '1.1', '2.0', '2.0b1'])
+
+    def test_offline(self):
+        cache = IndexCache(self.tempdir, offline=True)
+        self.assertRaises(IOError, cache.get_versions, 'foo',
+                          self.index.url)
+
+        IndexCache(self.tempdir).get_versions('foo', self.index.url)
+        self.index.stop()
+        cache = IndexCache(self.tempdir, offline=True)
+        self.assertEqual(cache.get_versions('foo', self.index.url),
+                         ['1.0', '1.1', '2.0b1'])
+
+    def test_unreachable_index(self):
+        cache = IndexCache(self.tempdir, ttl=0)
+        cache.get_versions('foo', self.index.url)
+        self.index.stop()
+
+        old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            versions = cache.get_versions('foo', self.index.url)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(versions, ['1.0', '1.1', '2.0b1'])
+
+    def test_broken_response(self):
+        cache = IndexCache(self.tempdir, ttl=0)
+        cache.get_versions('foo', self.index.url)
+
+        def _fetch(url, headers):
+            raise httplib.BadStatusLine('')
+
+        cache.fetch = _fetch
+        old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            versions = cache.get_versions('foo', self.index.url)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(versions, ['1.0', '1.1', '2.0b1'])
@@ -0,0 +1,171 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" tests for mopytools.plan
+"""
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+import StringIO
+from optparse import Values
+
+from mopytools import build_app, build_rpms, plan
+from mopytools.build import BuildSession
+from mopytools.util import step, PYTHON
+from mopytools.tests.bench_build import create_workspace
+from mopytools.tests.support import require_git
+
+
+@step('Building %(name)s')
+def _build(name=None):
+    pass
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def test_durations(self):
+        path = os.path.join(self.tempdir, 'durations')
+        plan.get_durations().clear()
+        _build(name='foo')
+        plan.save_durations(path)
+        self.assertEqual(plan.load_durations(path).keys(), ['Building foo'])
+
+        # the durations of the previous runs are kept
+        plan.get_durations().clear()
+        _build(name='bar')
+        plan.save_durations(path)
+        self.assertEqual(sorted(plan.load_durations(path)),
+                         ['Building bar', 'Building foo'])
+
+    def test_total(self):
+        build = plan.Plan({'one': 1, 'two': 2, 'three': 3})
+        first = build.add('one')
+        build.add('two', after=[first])
+        build.add('three', after=[first])
+        build.add('four', skip='up to date')
+        build.add('five')
+        # one then three, the longest of the parallel steps
+        self.assertEqual(build.total(), (4, 1))
+
+        stream = StringIO.StringIO()
+        build.display(stream)
+        output = stream.getvalue()
+        self.assertTrue('skipped: up to date' in output)
+        self.assertTrue('5 steps, 4 to run, estimated duration 4.0s' in output)
+
+    def test_plan_buildapp(self):
+        require_git()
+        app, deps = create_workspace(self.tempdir, deps=2, tags=3,
+                                     packages=2)
+        os.chdir(app)
+        options = Values({'force': False, 'reinstall': False, 'jobs': 1,
+                          'index': 'http://index', 'extras': None})
+        old_root = build_app.REPO_ROOT
+        build_app.REPO_ROOT = os.path.join(self.tempdir, 'repos') + os.sep
+        try:
+            build = plan.Plan({'Getting dep0': 2.0})
+            session = BuildSession(deps, 'prod')
+            build_app.plan_buildapp(session, options, build)
+            names = [step['name'] for step in build.steps]
+            self.assertEqual(names, ['Updating the repo', 'Getting dep0',
+                                     'Getting dep1',
+                                     'Building External dependencies',
+                                     'Now building the app itself'])
+            getting = build.steps[1]
+            self.assertTrue(getting['commands'][0].startswith('git clone'))
+            # the tag is looked up on the remote
+            self.assertEqual(getting['commands'][1], 'git checkout "rpm-0.2"')
+            self.assertEqual(build.cost(2), 2.0)
+            pip = build.steps[3]['commands']
+            self.assertTrue(pip[0].endswith('(2 of 2 requirements)'))
+
+            # once checked out, only setup.py develop is left
+            deps_dir = os.path.join(app, 'deps')
+            os.mkdir(deps_dir)
+            build_app.checkout_dep('dep0', deps_dir)
+            os.chdir(app)
+            build = plan.Plan()
+            build_app.plan_buildapp(session, options, build)
+            self.assertEqual(build.steps[1]['commands'],
+                             ['%s setup.py develop' % PYTHON])
+            self.assertEqual(os.getcwd(), app)
+        finally:
+            build_app.REPO_ROOT = old_root
+
+    def test_plan_buildrpms(self):
+        os.chdir(self.tempdir)
+        with open('prod-reqs.txt', 'w') as f:
+            f.write('foo==1.0\nbar==2.0\n')
+        options = Values({'dist_dir': 'rpms', 'index': 'http://index',
+                          'download_cache': None, 'rpm_cache': None,
+                          'jobs': 1})
+        old_resolve = build_rpms.resolve_requirements
+        build_rpms.resolve_requirements = lambda lines, index: [
+            line.split('==') for line in lines]
+        try:
+            build = plan.Plan({"Building the project's RPM": 3.0,
+                               'Building dep0': 3.0,
+                               'Building foo at version 1.0': 2.0,
+                               'Building bar at version 2.0': 2.0})
+            buildapp = build.add('Building the app')
+            session = BuildSession(['dep0'], 'prod')
+            build_rpms.plan_buildrpms(session, options, build)
+            afters = [step['after'] for step in build.steps]
+            # the external deps are built while the internal ones are
+            self.assertEqual(afters, [[], [1], [2], [buildapp], [4]])
+            self.assertEqual(build.total(), (6.0, 1))
+
+            # and in parallel with --jobs
+            options.jobs = 2
+            build = plan.Plan(build.durations)
+            buildapp = build.add('Building the app')
+            build_rpms.plan_buildrpms(session, options, build)
+            afters = [step['after'] for step in build.steps]
+            self.assertEqual(afters, [[], [1], [2], [buildapp], [buildapp]])
+        finally:
+            build_rpms.resolve_requirements = old_resolve
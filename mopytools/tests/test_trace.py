@@ -0,0 +1,106 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" tests for mopytools.trace
+"""
+import unittest
+import tempfile
+import shutil
+import json
+import sys
+import os
+import StringIO
+
+from mopytools import trace
+from mopytools.util import step, run, run_jobs
+
+
+@step('Building %(name)s')
+def _build(name=None):
+    run('echo %s' % name)
+    run('exit 2', allow_exit=True)
+
+
+def _job(name):
+    run('echo %s' % name)
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tracer = trace._TRACER = trace.Tracer()
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        trace.stop_tracing()
+        shutil.rmtree(self.tempdir)
+
+    def test_spans(self):
+        _build(name='foo')
+        events = dict((event['name'], event) for event in self.tracer.events)
+        self.assertEqual(len(events), 3)
+
+        step = events['Building foo']
+        self.assertEqual(step['cat'], 'step')
+        self.assertEqual(step['args']['parent'], None)
+
+        command = events['exit 2']
+        self.assertEqual(command['cat'], 'command')
+        self.assertEqual(command['args']['exit_code'], 2)
+        self.assertEqual(command['args']['parent'], 'Building foo')
+        self.assertEqual(command['args']['cwd'], os.getcwd())
+
+        # the commands are nested in the step
+        for name in ('echo foo', 'exit 2'):
+            self.assertTrue(events[name]['ts'] >= step['ts'])
+            self.assertTrue(events[name]['ts'] + events[name]['dur'] <=
+                            step['ts'] + step['dur'])
+
+        path = os.path.join(self.tempdir, 'trace.json')
+        self.tracer.save(path)
+        with open(path) as f:
+            self.assertEqual(len(json.load(f)['traceEvents']), 3)
+
+    def test_jobs_spans(self):
+        calls = [(('one',), {}), (('two',), {})]
+        list(run_jobs(_job, calls, jobs=2))
+        names = sorted(event['name'] for event in self.tracer.events)
+        self.assertEqual(names, ['_job one', '_job two', 'echo one',
+                                 'echo two'])
+        pids = set(event['pid'] for event in self.tracer.events)
+        self.assertFalse(os.getpid() in pids)
@@ -0,0 +1,568 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" tests for mopytools.util
+"""
+import unittest
+import threading
+import time
+import tempfile
+import shutil
+import sys
+import os
+import subprocess
+import StringIO
+
+from mopytools import util
+from mopytools.index import IndexCache, get_index_cache, set_index_cache
+from mopytools.tests.support import SimpleIndex, require_git
+from mopytools.tests.bench_build import create_repo, _call
+
+
+def _job(value):
+    print('working on %s' % value)
+    if value == 'boom':
+        sys.exit(3)
+    return value * 2
+
+
+def _command_job(pid_file, delay, code=0):
+    util.run('echo $$ > %s && sleep %s && exit %d' % (pid_file, delay, code))
+
+
+def _is_zombie(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().split()[2] == 'Z'
+    except IOError:
+        return False
+
+
+def _is_running(pid, wait=5):
+    # zombies are not running anymore
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        if _is_zombie(pid):
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def _command_jobs(pid_files):
+    calls = [((pid_file, 30), {}) for pid_file in pid_files]
+    for result in util.run_jobs(_command_job, calls, jobs=len(calls)):
+        pass
+
+
+class TestUtil(unittest.TestCase):
+
+    def test_run_jobs(self):
+        calls = [(('a',), {}), (('b',), {}), (('boom',), {})]
+        results = sorted(util.run_jobs(_job, calls, jobs=2))
+        self.assertEqual(len(results), 3)
+
+        index, code, result, output, duration = results[0]
+        self.assertEqual((index, code, result), (0, 0, 'aa'))
+        self.assertEqual(output, 'working on a\n')
+
+        index, code, result, output, duration = results[2]
+        self.assertEqual((index, code, result), (2, 3, None))
+        self.assertEqual(output, 'working on boom\n')
+
+    def test_run_jobs_abort(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            pid_files = [os.path.join(tempdir, str(index))
+                         for index in range(2)]
+            calls = [((pid_file, 30), {}) for pid_file in pid_files]
+            calls.append(((os.path.join(tempdir, 'boom'), 0.5, 3), {}))
+            results = util.run_jobs(_command_job, calls, jobs=3)
+            for index, code, result, output, duration in results:
+                self.assertEqual(index, 2)
+                break
+            results.close()
+
+            # the commands of the pending jobs are killed
+            for pid_file in pid_files:
+                with open(pid_file) as f:
+                    self.assertFalse(_is_running(int(f.read())))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_background_job(self):
+        job = util.BackgroundJob(_job, 'a')
+        self.assertEqual(job.wait(), (0, 'working on a\n'))
+        self.assertFalse(os.path.exists(job.log_path))
+
+        job = util.BackgroundJob(_job, 'boom')
+        self.assertEqual(job.wait(), (3, 'working on boom\n'))
+
+        job = util.BackgroundJob(time.sleep, 30)
+        code, output = job.stop()
+        self.assertEqual(code, 143)
+        self.assertTrue(job.duration < 30)
+
+    def test_background_job_stop(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            pid_files = [os.path.join(tempdir, str(index))
+                         for index in range(2)]
+            job = util.BackgroundJob(_command_jobs, pid_files)
+            while not all(os.path.exists(pid_file)
+                          for pid_file in pid_files):
+                time.sleep(0.1)
+            time.sleep(0.2)
+            self.assertEqual(job.stop()[0], 143)
+
+            # the commands of its pool are killed
+            for pid_file in pid_files:
+                with open(pid_file) as f:
+                    self.assertFalse(_is_running(int(f.read())))
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SimpleIndex({'foo': ['1.0', '1.1', '1.2a1'],
+                                  'bar': ['0.9', '1.0'],
+                                  'baz': ['0.1', '0.2']}).start()
+        self.old_cache = get_index_cache()
+        set_index_cache(IndexCache())
+
+    def tearDown(self):
+        set_index_cache(self.old_cache)
+        self.index.stop()
+
+    def test_resolve_requirements(self):
+        lines = ['foo>=1.0', 'bar==0.9', 'baz', 'foo<1.1', 'bar!=1.0']
+        plan = util.resolve_requirements(lines, self.index.url, jobs=4)
+        self.assertEqual(plan, [('foo', '1.2a1'), ('bar', '0.9'),
+                                ('baz', '0.2'), ('foo', '1.0'),
+                                ('bar', '0.9')])
+        self.assertEqual(len(self.index.requests), 3)
+
+    def test_keep_alive(self):
+        lines = ['foo', 'bar>0.1', 'baz<1.0']
+        util.resolve_requirements(lines, self.index.url, jobs=1)
+        self.assertEqual(len(self.index.requests), 3)
+        self.assertEqual(len(self.index.connections), 1)
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        shutil.rmtree(self.tempdir)
+
+    def test_output_tail(self):
+        log_file = os.path.join(self.tempdir, 'build.log')
+        cmd = 'for i in $(seq 1000); do echo $i; echo err$i >&2; done'
+        code, out, err = util.run(cmd, log_file=log_file)
+        self.assertEqual(code, 0)
+        self.assertEqual(out.split(), [str(i) for i in range(801, 1001)])
+        self.assertEqual(err.split()[-1], 'err1000')
+        self.assertEqual(len(err.split()), util.OUTPUT_LINES)
+
+        # the log has it all
+        with open(log_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[:2], ['', '$ ' + cmd])
+        self.assertEqual(len(lines), 2002)
+
+    def test_verbose(self):
+        util.run('echo one; echo two', verbose=True)
+        self.assertTrue('one\ntwo\n' in sys.stdout.getvalue())
+
+    def test_failure(self):
+        code, out, err = util.run('echo oops; exit 3', allow_exit=True)
+        self.assertEqual((code, out), (3, 'oops\n'))
+        self.assertRaises(SystemExit, util.run, 'exit 3')
+
+    def test_failure_at_exit(self):
+        # the timeout thread is over before the interpreter exits
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        code = 'from mopytools.util import run; run("echo hi; false")'
+        for i in range(5):
+            sub = subprocess.Popen([sys.executable, '-c', code], env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+            out, err = sub.communicate()
+            self.assertEqual(sub.returncode, 1)
+            self.assertFalse('Exception in thread' in err, err)
+
+    def test_timeout(self):
+        # the command starts a grandchild that would outlive its shell
+        pidfile = os.path.join(self.tempdir, 'pid')
+        cmd = ('sh -c \'echo $$ > %s; echo started; exec sleep 30\' & '
+               'wait' % pidfile)
+        old_grace = util.KILL_GRACE
+        util.KILL_GRACE = 1
+        start = time.time()
+        try:
+            self.assertRaises(SystemExit, util.run, cmd, timeout=1)
+        finally:
+            util.KILL_GRACE = old_grace
+        self.assertTrue(time.time() - start < 10)
+        self.assertTrue('started' in sys.stdout.getvalue())
+
+        with open(pidfile) as f:
+            pid = int(f.read())
+        time.sleep(0.2)
+        self.assertFalse(_is_running(pid))
+
+    def test_timeout_in_threads(self):
+        results = []
+
+        def _run():
+            results.append(util.run('sleep 0.1; echo ok', timeout=5))
+
+        threads = [threading.Thread(target=_run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [(0, 'ok\n', '')] * 4)
+
+
+_SETUP = """\
+import os
+with open('calls', 'a') as f:
+    f.write('develop\\n')
+if not os.path.exists('foo.egg-info'):
+    os.mkdir('foo.egg-info')
+with open(os.path.join('site', 'foo.egg-link'), 'w') as f:
+    f.write(os.getcwd() + '\\n.\\n')
+"""
+
+
+class TestDevelop(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        with open('setup.py', 'w') as f:
+            f.write(_SETUP)
+        os.mkdir('site')
+        self.old_site = util._SITE_PACKAGES.get(sys.executable)
+        util._SITE_PACKAGES[sys.executable] = os.path.join(self.tempdir,
+                                                           'site')
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        if self.old_site is None:
+            del util._SITE_PACKAGES[sys.executable]
+        else:
+            util._SITE_PACKAGES[sys.executable] = self.old_site
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def _calls(self):
+        with open('calls') as f:
+            return len(f.readlines())
+
+    def test_develop_once(self):
+        self.assertTrue(util.develop(sys.executable))
+        self.assertFalse(util.develop(sys.executable))
+        self.assertEqual(self._calls(), 1)
+
+        # forced
+        self.assertTrue(util.develop(sys.executable, force=True))
+        self.assertEqual(self._calls(), 2)
+
+    def test_environment_recreated(self):
+        util.develop(sys.executable)
+        # a new virtualenv at the same path
+        os.remove(os.path.join('site', 'foo.egg-link'))
+        self.assertTrue(util.develop(sys.executable))
+        self.assertFalse(util.develop(sys.executable))
+        self.assertEqual(self._calls(), 2)
+
+    def test_requirements_changed(self):
+        util.develop(sys.executable)
+        with open('prod-reqs.txt', 'w') as f:
+            f.write('foo==1.0\n')
+        self.assertTrue(util.develop(sys.executable))
+        self.assertFalse(util.develop(sys.executable))
+        self.assertEqual(self._calls(), 2)
+
+
+_PIP = """\
+#!/bin/sh
+# records the requirement lines pip was asked to install, and builds
+# empty wheels
+command=$1
+shift
+while [ $# -gt 0 ]; do
+    case "$1" in
+    -r) shift; cat "$1" >> pip-calls; echo "--" >> pip-calls;;
+    --no-index) echo "offline" >> pip-offline;;
+    --wheel-dir) shift; house=$1;;
+    -i) shift;;
+    *==*) if [ "$command" = "wheel" ]; then
+              echo "$1" >> wheel-calls
+              name=$(echo "$1" | sed 's/-/_/g; s/==/-/')
+              touch "$house/$name-py2-none-any.whl"
+          fi;;
+    esac
+    shift
+done
+"""
+
+
+class TestInstallRequirements(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        os.mkdir('foo.egg-info')
+        self.pip = os.path.join(self.tempdir, 'pip')
+        with open(self.pip, 'w') as f:
+            f.write(_PIP)
+        os.chmod(self.pip, 0755)
+        self.old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.old_stdout
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def _install(self, lines, **kw):
+        with open('prod-reqs.txt', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return util.install_requirements('prod-reqs.txt', 'http://index',
+                                         pip=self.pip, **kw)
+
+    def _calls(self):
+        if not os.path.exists('pip-calls'):
+            return []
+        with open('pip-calls') as f:
+            calls = f.read().split('--\n')[:-1]
+        return [call.split() for call in calls]
+
+    def test_satisfied(self):
+        import nose
+        installed = 'nose==%s' % nose.__version__
+
+        # everything is there, pip is not called
+        self.assertEqual(self._install([installed]), [])
+        self.assertEqual(self._calls(), [])
+
+        # pip only gets the missing lines
+        missing = 'MissingProject==1.0'
+        self.assertEqual(self._install(['# comment', installed, missing]),
+                         [missing])
+        self.assertEqual(self._calls(), [[missing]])
+        self.assertEqual([path for path in os.listdir('.')
+                          if path.endswith('-reqs.txt')], ['prod-reqs.txt'])
+
+        # forced
+        self.assertEqual(self._install([installed], force=True), [installed])
+
+    def test_unpinned(self):
+        # unpinned lines are satisfied by any version, so pip upgrades
+        # them until the same requirements were installed once
+        self._install(['nose'])
+        self._install(['nose'])
+        self.assertEqual(self._calls(), [['nose']])
+        self._install(['nose', 'coverage'])
+        self.assertEqual(self._calls(), [['nose'], ['nose', 'coverage']])
+
+    def test_wheelhouse(self):
+        wheelhouse = os.path.join(self.tempdir, 'wheels')
+        lines = ['MissingProject==1.0', 'other-project==2.0']
+        self._install(lines, wheelhouse=wheelhouse)
+        self.assertEqual(self._calls(), [lines])
+
+        house, = os.listdir(wheelhouse)
+        self.assertTrue(house.startswith('cp%d%d-' % sys.version_info[:2]))
+        self.assertEqual(sorted(os.listdir(os.path.join(wheelhouse, house))),
+                         ['MissingProject-1.0-py2-none-any.whl',
+                          'other_project-2.0-py2-none-any.whl'])
+
+        # the wheels are only built once, and installed offline
+        self._install(lines + ['MissingProject2==1.0'],
+                      wheelhouse=wheelhouse)
+        with open('wheel-calls') as f:
+            self.assertEqual(f.read().split(),
+                             lines + ['MissingProject2==1.0'])
+        with open('pip-offline') as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+class TestRemoteTags(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_many_refs(self):
+        require_git()
+        repo = os.path.join(self.tempdir, 'repo')
+        create_repo(repo, 'repo', tags=0)
+        head = _call('git rev-parse HEAD', repo).strip()
+        tags = ['rpm-2.%d' % index for index in range(util.OUTPUT_LINES)]
+        tags.append('rpm-10.0')
+        _call('git update-ref --stdin', repo,
+              ''.join('create refs/tags/%s %s\n' % (tag, head)
+                      for tag in tags))
+
+        index = util.get_remote_tag_index(repo)
+        self.assertEqual(len(index.refs), len(tags) + 1)
+        self.assertEqual(index.get_channel_tag('prod'), 'rpm-10.0')
+
+
+class TestHasChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        util.forget_changes()
+
+    def tearDown(self):
+        util.forget_changes()
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def test_git(self):
+        require_git()
+        create_repo(self.tempdir + '/repo', 'repo', tags=1)
+        os.chdir(self.tempdir + '/repo')
+        self.assertFalse(util.has_changes())
+
+        # the answer is kept for the revision
+        with open('setup.py', 'a') as f:
+            f.write('# changed\n')
+        self.assertFalse(util.has_changes())
+        util.forget_changes(os.getcwd())
+        self.assertTrue(util.has_changes())
+
+        # a new revision is looked at again
+        _call('git commit -q -a -m changed', os.getcwd())
+        self.assertFalse(util.has_changes())
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dir = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        self.commands = []
+        self.old_run = util.run
+
+        def _run(cmd, *args, **kw):
+            self.commands.append(cmd)
+            return self.old_run(cmd, *args, **kw)
+
+        util.run = _run
+
+    def tearDown(self):
+        util.run = self.old_run
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_sources(self):
+        self._write('setup.py', 'from setuptools import setup\n'
+                                'setup(name="FromSetup", version="1.1")\n')
+        meta = util.get_metadata()
+        self.assertEqual(meta.name, 'FromSetup')
+        self.assertEqual(len(self.commands), 1)
+
+        # the result is kept
+        self.assertEqual(util.get_metadata().name, 'FromSetup')
+        self.assertEqual(len(self.commands), 1)
+
+        # setup.cfg is read before running setup.py
+        self._write('setup.cfg', '[metadata]\nname = FromCfg\n')
+        self.assertEqual(util.get_metadata().name, 'FromCfg')
+
+        # and PKG-INFO first
+        os.mkdir('FromEgg.egg-info')
+        self._write(os.path.join('FromEgg.egg-info', 'PKG-INFO'),
+                    'Metadata-Version: 1.0\nName: FromEgg\nVersion: 1.2\n')
+        meta = util.get_metadata()
+        self.assertEqual((meta.name, meta.version), ('FromEgg', '1.2'))
+        self.assertEqual(len(self.commands), 1)
+
+    def test_quoted_location(self):
+        location = os.path.join(self.tempdir, "it's mine")
+        os.mkdir(location)
+        self._write(os.path.join(location, 'setup.py'),
+                    'from setuptools import setup\n'
+                    'setup(name="Mine", version="1.0")\n')
+        self.assertEqual(util.get_metadata(location).name, 'Mine')
+        self.assertEqual(len(self.commands), 1)
+
+    def test_egg_info_safe_name(self):
+        self._write('setup.py', 'from setuptools import setup\n'
+                                'setup(name="Mozsvc_Foo", version="1.0")\n')
+        os.mkdir('Mozsvc_Foo.egg-info')
+        self._write(os.path.join('Mozsvc_Foo.egg-info', 'PKG-INFO'),
+                    'Metadata-Version: 1.0\nName: Mozsvc-Foo\n'
+                    'Version: 1.0\n')
+        # the egg-info name is not the one setup.py gives
+        self.assertEqual(util.get_metadata().name, 'Mozsvc_Foo')
+        self.assertEqual(len(self.commands), 1)
+
+    def test_spec(self):
+        self.assertTrue(util.is_meta_project())
+        self._write('app.spec', 'Name: app\nUrl: https://example.com/app\n')
+        self.assertFalse(util.is_meta_project())
+        self.assertEqual(util.get_spec_file(),
+                         os.path.join(self.tempdir, 'app.spec'))
+        self.assertEqual(util.get_project_name(), 'app')
+        self.assertEqual(self.commands, [])
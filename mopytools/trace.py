@@ -0,0 +1,132 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instea
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Timeline of a build, in the Chrome trace-event format.
+
+When tracing is on, every step and every command run by mopytools is
+recorded as a span. The resulting JSON file can be loaded in
+chrome://tracing or any viewer that reads the trace-event format.
+"""
+import os
+import time
+import json
+import atexit
+import threading
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    """Records nested spans as complete ("X") trace events."""
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        """Returns the name of the innermost open span, if any."""
+        stack = self._stack()
+        return stack and stack[-1] or None
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Records the span of the with block.
+
+        The yielded args dict can be updated before the span is over.
+        """
+        stack = self._stack()
+        args['parent'] = stack and stack[-1] or None
+        args['cwd'] = os.getcwd()
+        stack.append(name)
+        start = time.time()
+        try:
+            yield args
+        finally:
+            end = time.time()
+            stack.pop()
+            self.add({'name': name, 'cat': category, 'ph': 'X',
+                      'ts': int(start * 1000000),
+                      'dur': int((end - start) * 1000000),
+                      'pid': os.getpid(),
+                      'tid': threading.current_thread().ident,
+                      'args': args})
+
+    def add(self, *events):
+        with self._lock:
+            self.events.extend(events)
+
+    def save(self, path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events,
+                       'displayTimeUnit': 'ms'}, f)
+
+
+_TRACER = None
+
+
+def get_tracer():
+    """Returns the current Tracer, or None when tracing is off."""
+    return _TRACER
+
+
+def start_tracing(path):
+    """Starts recording spans, and saves them in path when exiting."""
+    global _TRACER
+    if _TRACER is not None:
+        return _TRACER
+    _TRACER = Tracer()
+    atexit.register(_TRACER.save, path)
+    return _TRACER
+
+
+def stop_tracing():
+    global _TRACER
+    _TRACER = None
+
+
+@contextmanager
+def span(name, category, **args):
+    """Records a span when tracing is on, does nothing otherwise."""
+    if _TRACER is None:
+        yield args
+    else:
+        with _TRACER.span(name, category, **args) as args:
+            yield args
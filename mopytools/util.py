@@ -40,17 +40,28 @@ import sys
 import re
 import subprocess
 import socket
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 from urlparse import urlparse
 from ConfigParser import ConfigParser
 from optparse import OptionParser
 import signal
-
-from distutils2.version import (NormalizedVersion, IrrationalVersionError,
-                                suggest_normalized_version)
-from distutils2.index.simple import Crawler, DEFAULT_SIMPLE_INDEX_URL
-from pkg_resources import parse_version
-
-from pip.req import parse_requirements
+import glob
+import pipes
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, deque
+
+# distutils2, pkg_resources and pip are slow to import: they are only
+# imported by the functions using them, so that starting the scripts
+# doesn't pay for code paths a build may not take.
+from mopytools.index import (IndexCache, get_index_cache, set_index_cache,
+                             DEFAULT_SIMPLE_INDEX_URL)
+from mopytools.trace import span, get_tracer, start_tracing
+from mopytools.plan import record_duration, get_durations
 
 
 REPO_ROOT = 'https://hg.mozilla.org/services/'
@@ -66,58 +77,268 @@ def is_git():
     return '.git' in os.listdir('.')
 
 
-def _sort_tags(tags):
-    # tags may come unordered
-    def _sort_version(version1, version2):
-        nv1 = suggest_normalized_version(version1)
-        nv2 = suggest_normalized_version(version2)
-        if nv1 is not None and nv2 is not None:
-            # we can use d2 to sort
-            if nv1 < nv2:
-                return -1
-            elif nv1 > nv2:
-                return 1
-            return 0
-        else:
-            # we fallback to setuptools sorting
-            return cmp(parse_version(version1), parse_version(version2))
+_MISSING = object()
 
-    tags.sort(cmp=_sort_version)
-    tags.reverse()
 
+def memoize(size):
+    """Memoizes a one-argument function, keeping at most `size` results.
 
-def _get_tags(prefix=TAG_PREFIX):
-    if is_git():
-        cmds = ['git tag', 'git branch']
-    else:
-        cmds = ['hg tags', 'hg branches']
+    When the cache is full, the oldest results are dropped first.
+    """
+    def _memoize(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        def __memoize(arg):
+            res = cache.get(arg, _MISSING)
+            if res is not _MISSING:
+                return res
+            res = func(arg)
+            with lock:
+                cache[arg] = res
+                while len(cache) > size:
+                    cache.popitem(last=False)
+            return res
+        __memoize.cache = cache
+        return __memoize
+    return _memoize
+
+
+# each version string is parsed once into a comparable key
+_VERSIONS_CACHE_SIZE = 20000
+
+
+@memoize(_VERSIONS_CACHE_SIZE)
+def normalized_version(version):
+    """Returns the NormalizedVersion of version, or None if irrational."""
+    from distutils2.version import NormalizedVersion, IrrationalVersionError
+    try:
+        return NormalizedVersion(version)
+    except IrrationalVersionError:
+        return None
 
-    output = ''
+
+@memoize(_VERSIONS_CACHE_SIZE)
+def suggested_version(version):
+    """Returns the NormalizedVersion suggested for version, or None."""
+    from distutils2.version import suggest_normalized_version
+    normalized = suggest_normalized_version(version)
+    if normalized is None:
+        return None
+    return normalized_version(normalized)
+
+
+@memoize(_VERSIONS_CACHE_SIZE)
+def legacy_version(version):
+    """Returns setuptools' parsed version."""
+    from pkg_resources import parse_version
+    return parse_version(version)
+
+
+def _tag_keys(tags):
+    """Returns a list of (sort key, tag), parsing each tag only once.
+
+    Tags are compared as distutils2 versions when they can all be
+    normalized, and with setuptools' parse_version otherwise.
+    """
+    keys = []
+    for tag in tags:
+        normalized = suggested_version(tag)
+        if normalized is None:
+            return [(legacy_version(tag), tag) for tag in tags]
+        keys.append((normalized, tag))
+    return keys
+
+
+def _channel_version(tag):
+    """Returns the NormalizedVersion of a channel tag, or None."""
+    version = tag[len(TAG_PREFIX):]
+    if '-' in version:
+        version = version.replace('-', '.')
+    return normalized_version(version)
+
+
+def _select_channel_tag(keys, channel):
+    """Returns the latest tag of the channel, in a single pass over keys.
+
+    - prod tags are final tags
+    - stage tags is the latest rc tags that is
+      after the latest prod tag if any, or prod tag
+    """
+    best = None
+    for key, tag in keys:
+        if best is not None and key < best[0]:
+            continue
+        version = _channel_version(tag)
+        if version is None:
+            continue
+        if channel == 'prod' and not version.is_final:
+            continue
+        best = key, tag
+    return best and best[1] or None
+
+
+def _get_git_dir(root='.'):
+    """Returns the git directory of the repository located at root."""
+    git_dir = os.path.join(root, '.git')
+    if os.path.isfile(git_dir):
+        # submodules and worktrees point to their git dir
+        with open(git_dir) as f:
+            line = f.read().strip()
+        if line.startswith('gitdir:'):
+            git_dir = os.path.join(root, line[len('gitdir:'):].strip())
+    return git_dir
+
+
+def _git_signature(git_dir):
+    """Returns a value that changes whenever a tag or branch changes."""
+    signature = []
+    packed = os.path.join(git_dir, 'packed-refs')
+    if os.path.exists(packed):
+        signature.append((packed, os.path.getmtime(packed)))
+    for kind in ('tags', 'heads'):
+        root = os.path.join(git_dir, 'refs', kind)
+        for dirpath, dirnames, filenames in os.walk(root):
+            signature.append((dirpath, os.path.getmtime(dirpath)))
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                signature.append((path, os.path.getmtime(path)))
+    return tuple(signature)
+
+
+def _read_git_refs(git_dir):
+    """Reads tags and branches from the refs files of a git repository.
+
+    Returns a mapping of tag and branch names to their commit.
+    """
+    refs = {}
+    packed = os.path.join(git_dir, 'packed-refs')
+    if os.path.exists(packed):
+        name = None
+        with open(packed) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('^'):
+                    # commit of the previous annotated tag
+                    if name is not None:
+                        refs[name] = line[1:]
+                    continue
+                sha, ref = line.split(' ', 1)
+                name = None
+                for kind in ('refs/tags/', 'refs/heads/'):
+                    if ref.startswith(kind):
+                        name = ref[len(kind):]
+                        refs[name] = sha
+
+    # loose refs take precedence over packed ones
+    for kind in ('tags', 'heads'):
+        root = os.path.join(git_dir, 'refs', kind)
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                with open(path) as f:
+                    refs[name] = f.read().strip()
+    return refs
+
+
+def _read_cmds_refs(cmds):
+    """Builds the refs mapping out of `git tag`, `hg tags`-like outputs."""
+    refs = {}
     for cmd in cmds:
         sub = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        addl = sub.stdout.read().strip()
-        if addl:
-            if output:
-                output += '\n'
-            output += addl
-    if output == '':
-        return []
-
-    tags = []
-    for line in output.split('\n'):
-        tag = line.split()[0]
-        tag = tag.lstrip('*')
-        tag = tag.strip()
-        if tag.startswith(prefix):
-            tags.append(tag)
-    _sort_tags(tags)
-    return tags
+        for line in sub.stdout:
+            line = line.lstrip('*').split()
+            if line == []:
+                continue
+            # hg gives rev:node, git tag only gives names
+            refs[line[0]] = len(line) > 1 and line[1].split(':')[-1] or None
+    return refs
+
+
+def _hg_signature(root='.'):
+    signature = []
+    for path in (('store', '00changelog.i'), ('localtags',), ('branch',)):
+        path = os.path.join(root, '.hg', *path)
+        if os.path.exists(path):
+            signature.append((path, os.path.getmtime(path),
+                              os.path.getsize(path)))
+    return tuple(signature)
+
+
+class TagIndex(object):
+    """Tags and branches of a repository, with their revisions.
+
+    For git, loose annotated tags point to the tag object rather than
+    to the commit.
+    """
+    def __init__(self, refs, signature=None):
+        self.refs = refs
+        self.signature = signature
+        self._keys = {}
+        self._sorted = {}
+        self._channels = {}
+
+    def get_keys(self, prefix=TAG_PREFIX):
+        """Returns the (sort key, tag) list of the tags starting with prefix.
+        """
+        if prefix not in self._keys:
+            tags = [tag for tag in self.refs if tag.startswith(prefix)]
+            self._keys[prefix] = _tag_keys(tags)
+        return self._keys[prefix]
+
+    def get_tags(self, prefix=TAG_PREFIX):
+        if prefix not in self._sorted:
+            keys = sorted(self.get_keys(prefix), key=lambda key: key[0])
+            self._sorted[prefix] = [tag for key, tag in reversed(keys)]
+        return list(self._sorted[prefix])
+
+    def get_channel_tag(self, channel):
+        if channel not in self._channels:
+            self._channels[channel] = _select_channel_tag(self.get_keys(),
+                                                          channel)
+        return self._channels[channel]
+
+
+_TAG_INDEXES = {}
+
+
+def get_tag_index():
+    """Returns the TagIndex of the repository in the current dir.
+
+    The index is built once, then reused until the repository refs
+    change. For git, the refs are read directly from the .git dir.
+    """
+    root = os.getcwd()
+    index = _TAG_INDEXES.get(root)
+    if is_git():
+        git_dir = _get_git_dir()
+        if os.path.isdir(os.path.join(git_dir, 'refs')):
+            signature = _git_signature(git_dir)
+            if index is None or index.signature != signature:
+                refs = _read_git_refs(git_dir)
+                index = _TAG_INDEXES[root] = TagIndex(refs, signature)
+            return index
+        cmds, signature = ['git tag', 'git branch'], None
+    else:
+        cmds, signature = ['hg tags', 'hg branches'], _hg_signature()
+
+    if index is None or not signature or index.signature != signature:
+        index = _TAG_INDEXES[root] = TagIndex(_read_cmds_refs(cmds),
+                                              signature)
+    return index
+
+
+def _get_tags(prefix=TAG_PREFIX):
+    return get_tag_index().get_tags(prefix)
 
 
 def tag_exists(tag):
     if tag in ('tip', 'defaut') or tag.isdigit():
         return True
-    return tag in _get_tags()
+    return tag.startswith(TAG_PREFIX) and tag in get_tag_index().refs
 
 
 def get_channel_tag(channel):
@@ -126,41 +347,14 @@ def get_channel_tag(channel):
             return 'master'
         return 'default'
 
-    tags = _get_tags()
-
-    if len(tags) == 0:
+    index = get_tag_index()
+    if len(index.get_keys()) == 0:
         print ('Could not find any %s* tag' % TAG_PREFIX)
         sys.exit(0)
 
-    # looking for the latest channel tag
-    #
-    # - prod tags are final tags
-    # - stage tags is the latest rc tags that is
-    #   after the latest prod tag if any, or prod tag
-    def is_prod(tag):
-        try:
-            return NormalizedVersion(version).is_final
-        except IrrationalVersionError:
-            return False
-
-    def is_stage_or_prod(tag):
-        try:
-            NormalizedVersion(version)
-            return True
-        except IrrationalVersionError:
-            return False
-
-    if channel == "prod":
-        selector = is_prod
-    else:
-        selector = is_stage_or_prod
-
-    for tag in tags:
-        version = tag[len(TAG_PREFIX):]
-        if '-' in version:
-            version = version.replace('-', '.')
-        if selector(version):
-            return tag
+    tag = index.get_channel_tag(channel)
+    if tag is not None:
+        return tag
 
     print('Could not find a tag for channel %s' % channel)
     print('Make sure you have a %s-reqs.txt file' % channel)
@@ -176,6 +370,11 @@ def timeout_handler(signum, frame):
 
 
 def with_timer(duration, cleanup=None):
+    """Raises a TimeoutError in func after duration seconds.
+
+    This relies on SIGALRM, so it only works in the main thread. Commands
+    should be run with run(), which has its own timeout.
+    """
     def _timer(func):
         def __timer(*args, **kw):
             previous_sig = signal.signal(signal.SIGALRM, timeout_handler)
@@ -193,85 +392,794 @@ def with_timer(duration, cleanup=None):
     return _timer
 
 
-def run(command, timeout=300, verbose=False, allow_exit=False):
-    err_output = []
-    out_output = []
+# number of lines of each output kept by run()
+OUTPUT_LINES = 200
+
+# maximum size of a line read from a command output
+_LINE_SIZE = 8192
+
+_LOG_FILE = None
+
+
+def set_log_file(path):
+    """Sets the file where run() appends the full output of commands."""
+    global _LOG_FILE
+    _LOG_FILE = path
 
-    def _output():
-        out = 'Output:\n:%s' % '\n'.join(out_output)
-        err = '\n\nErrors:\n:%s' % '\n'.join(err_output)
-        return out + err
 
-    @with_timer(timeout)
-    def _run():
+def _read_output(stream, lines, verbose, log, lock):
+    # reads the stream line by line, keeping only the last lines
+    for line in iter(lambda: stream.readline(_LINE_SIZE), ''):
+        lines.append(line)
+        if verbose or log is not None:
+            with lock:
+                if verbose:
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+                if log is not None:
+                    log.write(line)
+    stream.close()
+
+
+# seconds given to a timed out command to terminate before it's killed
+KILL_GRACE = 5
+
+
+def _kill_group(pid, grace=KILL_GRACE):
+    """Terminates the process group pid, and kills it after grace seconds.
+    """
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except OSError:
+        # the group is already gone
+        return
+    time.sleep(grace)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def run(command, timeout=300, verbose=False, allow_exit=False,
+        log_file=None):
+    """Runs command in a shell.
+
+    The outputs are read as they are produced. In verbose mode, they are
+    displayed right away. Only the last OUTPUT_LINES lines of each output
+    are kept and returned, but the full output can be appended to
+    log_file, which defaults to the file set by set_log_file().
+
+    The command runs in its own process group. When it's still running
+    after timeout seconds, the whole group is terminated, including the
+    processes the command started, and the partial output is displayed.
+    run() can be called from any thread.
+
+    Returns a (code, stdout, stderr) tuple.
+    """
+    if log_file is None:
+        log_file = _LOG_FILE
+
+    out_output = deque(maxlen=OUTPUT_LINES)
+    err_output = deque(maxlen=OUTPUT_LINES)
+    timed_out = threading.Event()
+
+    def _run(log):
         if verbose:
             print('\n' + command)
+        if log is not None:
+            log.write('\n$ %s\n' % command)
 
         sb = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-
-        stdout, stderr = sb.communicate()
-        code = sb.returncode
-
-        if code != 0:
-            if not allow_exit or verbose:
-                print("%r failed with code %d" % (command, code))
+                              stderr=subprocess.PIPE, preexec_fn=os.setsid)
+
+        lock = threading.Lock()
+        readers = [threading.Thread(target=_read_output,
+                                    args=(stream, lines, verbose, log,
+                                          lock))
+                   for stream, lines in ((sb.stdout, out_output),
+                                         (sb.stderr, err_output))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        def _timeout():
+            timed_out.set()
+            _kill_group(sb.pid)
+
+        killer = None
+        if timeout:
+            killer = threading.Timer(timeout, _timeout)
+            killer.daemon = True
+            killer.start()
+        try:
+            code = sb.wait()
+        except BaseException:
+            # interrupted, we don't want to leave the command behind
+            _kill_group(sb.pid, 0)
+            raise
+        finally:
+            if killer is not None:
+                # a timer thread still running at exit makes the
+                # interpreter shutdown print errors
+                killer.cancel()
+                killer.join()
+
+        # processes that left the group may still hold the outputs
+        for reader in readers:
+            reader.join(KILL_GRACE)
+
+        return code, ''.join(out_output), ''.join(err_output)
+
+    log = None
+    if log_file is not None:
+        log = open(log_file, 'a')
+    try:
+        with span(command, 'command', command=command) as trace_args:
+            code, stdout, stderr = _run(log)
+            trace_args['exit_code'] = code
+            trace_args['timed_out'] = timed_out.is_set()
+    finally:
+        if log is not None:
+            log.close()
+
+    if timed_out.is_set():
+        print(command)
+        print("Timed out after %ss!" % timeout)
+        print(stdout)
+        print(stderr)
+        sys.exit(1)
+
+    if code != 0:
+        if not allow_exit or verbose:
+            print("%r failed with code %d" % (command, code))
+            if not verbose:
                 print(stdout)
                 print(stderr)
-            if not allow_exit:
-                sys.exit(code)
-        elif verbose:
-            print(stdout)
-            print(stderr)
+        if not allow_exit:
+            sys.exit(code)
+
+    return code, stdout, stderr
+
+
+class _Terminated(SystemExit):
+    """Raised in the job processes when they are terminated."""
 
-        return code, stdout, stderr
 
+def _terminated(signum, frame):
+    raise _Terminated(128 + signum)
+
+
+def _exit_on_sigterm():
+    # a terminated job process exits through the interrupted run(), which
+    # kills the command it was waiting for
+    signal.signal(signal.SIGTERM, _terminated)
+
+
+def _run_job(job):
+    """Runs a single job in a worker process.
+
+    Anything printed by the job is captured so the caller can display
+    it in one block once the job is over.
+    """
+    index, func, args, kw = job
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output = StringIO()
+    tracer = get_tracer()
+    if tracer is not None:
+        del tracer.events[:]
+    get_durations().clear()
+    start = time.time()
+    code, result = 0, None
     try:
-        return  _run()
-    except TimeoutError:
-        print(command)
-        print("Timed out!")
-        sys.exit(0)
+        name = '%s %s' % (func.__name__, args and args[0] or '')
+        with span(name, 'job') as trace_args:
+            try:
+                result = func(*args, **kw)
+            except _Terminated:
+                raise
+            except SystemExit, e:
+                code = e.code or 0
+            except Exception, e:
+                print('%s: %s' % (e.__class__.__name__, e))
+                code = 1
+            trace_args['exit_code'] = code
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+
+    # the spans and durations recorded in the worker go back to the main
+    # process
+    events = tracer is not None and tracer.events or []
+    return (index, code, result, output.getvalue(), time.time() - start,
+            events, get_durations())
+
+
+def _interruptible(results):
+    # waiting without a timeout would block signals in Python 2, and
+    # SIGTERM or Ctrl-C would only stop a job process once a job is over
+    while True:
+        try:
+            yield results.next(0.2)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+
+def run_jobs(func, calls, jobs=1):
+    """Runs func for every (args, kw) in calls using up to `jobs` processes.
+
+    Yields (index, code, result, output, duration) tuples as soon as each
+    job is over. `code` is the exit code of the job, 0 meaning success.
+    func has to be a module-level function so it can be pickled.
+
+    If the generator is closed before the end, pending jobs are killed.
+    """
+    calls = [(index, func, args, kw)
+             for index, (args, kw) in enumerate(calls)]
+    pool = multiprocessing.Pool(max(1, min(jobs, len(calls))),
+                                initializer=_exit_on_sigterm)
+    tracer = get_tracer()
+    try:
+        for res in _interruptible(pool.imap_unordered(_run_job, calls)):
+            if tracer is not None:
+                tracer.add(*res[-2])
+            get_durations().update(res[-1])
+            yield res[:-2]
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _background(conn, log_path, func, args, kw):
+    # a terminated job stops the commands it is running, including the
+    # ones of its run_jobs pools
+    _exit_on_sigterm()
+    sys.stdout = sys.stderr = open(log_path, 'w', 0)
+    tracer = get_tracer()
+    if tracer is not None:
+        del tracer.events[:]
+    get_durations().clear()
+    code = 0
+    with span(func.__name__, 'job') as trace_args:
+        try:
+            func(*args, **kw)
+        except SystemExit, e:
+            code = e.code or 0
+            if not isinstance(code, int):
+                print(code)
+                code = 1
+        except Exception, e:
+            print('%s: %s' % (e.__class__.__name__, e))
+            code = 1
+        trace_args['exit_code'] = code
+    events = tracer is not None and tracer.events or []
+    conn.send((code, events, get_durations()))
+    conn.close()
+
+
+class BackgroundJob(object):
+    """Runs func(*args, **kw) in a child process, which can itself use
+    run_jobs.
+
+    What the job prints goes to a temporary log, returned by wait() so
+    the caller can display it in one block. Like in run_jobs, the spans
+    and durations recorded by the job are sent back to the main process.
+    """
+    def __init__(self, func, *args, **kw):
+        fd, self.log_path = tempfile.mkstemp(prefix='mopytools-',
+                                             suffix='.log')
+        os.close(fd)
+        self._conn, child = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(
+            target=_background, args=(child, self.log_path, func, args, kw))
+        self.start = time.time()
+        self.duration = None
+        self.process.start()
+        child.close()
+
+    def wait(self):
+        """Waits for the job to be over. Returns its (code, output)."""
+        try:
+            code, events, durations = self._conn.recv()
+        except EOFError:
+            # the process died, maybe killed by a signal
+            self.process.join()
+            code = self.process.exitcode
+            if code < 0:
+                code = 128 - code
+            code, events, durations = code or 1, [], {}
+        self.process.join()
+        self.duration = time.time() - self.start
+
+        tracer = get_tracer()
+        if tracer is not None:
+            tracer.add(*events)
+        get_durations().update(durations)
+
+        with open(self.log_path) as f:
+            output = f.read()
+        os.remove(self.log_path)
+        return code, output
+
+    def stop(self):
+        """Terminates the job. Returns its (code, output)."""
+        if self.process.is_alive():
+            self.process.terminate()
+        return self.wait()
 
 
 def envname(name):
     return os.path.basename(name).upper().replace('-', '_')
 
 
+# (checkout location, revision) -> has local changes
+_CHANGES = {}
+
+
 def has_changes(timeout=5, verbose=False):
+    """Tells if the checkout in the current dir has local changes.
+
+    The diff itself is never produced: git stops at the first change and
+    hg only lists the changed files. The answer is kept for the location
+    and its revision until forget_changes() is called.
+    """
+    key = os.getcwd(), get_revision()
+    if key in _CHANGES:
+        return _CHANGES[key]
+
     if is_git():
-        code, out, err = run('git diff --exit-code', timeout, verbose,
+        code, out, err = run('git diff --quiet', timeout, verbose,
                              allow_exit=True)
-        return code == 1
+        if code not in (0, 1):
+            sys.exit(code)
+        dirty = code == 1
     else:
-        code, out, err = run('hg diff', timeout, verbose)
-        return out != ''
+        code, out, err = run('hg status -mard', timeout, verbose)
+        dirty = out.strip() != ''
 
+    _CHANGES[key] = dirty
+    return dirty
 
-def update_cmd(project=None, channel="prod", specific_tag=False,
-               force=False):
+
+def forget_changes(location=None):
+    """Forgets if the checkout at location, or everywhere, has changes."""
+    if location is None:
+        _CHANGES.clear()
+        return
+    location = os.path.abspath(location)
+    for key in _CHANGES.keys():
+        if key[0] == location:
+            del _CHANGES[key]
+
+
+def get_revision():
+    """Returns the revision checked out in the current dir, or None."""
+    if is_git():
+        git_dir = _get_git_dir()
+        head = os.path.join(git_dir, 'HEAD')
+        if not os.path.exists(head):
+            return None
+        with open(head) as f:
+            head = f.read().strip()
+        if not head.startswith('ref:'):
+            # detached head
+            return head
+        ref = head[len('ref:'):].strip()
+        if ref.startswith('refs/heads/'):
+            branch = ref[len('refs/heads/'):]
+            return get_tag_index().refs.get(branch)
+        return None
+
+    # the dirstate starts with the binary node of the working dir parent
+    dirstate = os.path.join('.hg', 'dirstate')
+    if not os.path.exists(dirstate):
+        return None
+    with open(dirstate, 'rb') as f:
+        node = f.read(20)
+    return len(node) == 20 and node.encode('hex') or None
+
+
+def is_checked_out(tag):
+    """Tells if tag is the revision checked out in the current dir, using
+    the local refs."""
+    revision = get_revision()
+    target = get_tag_index().refs.get(tag)
+    if revision is None or target is None:
+        return False
+    if revision.startswith(target):
+        # hg gives short nodes
+        return True
+    if is_git():
+        # annotated tags point to a tag object
+        code, out, err = run('git rev-parse "%s^{commit}"' % tag,
+                             allow_exit=True)
+        return code == 0 and out.strip() == revision
+    return False
+
+
+def get_remote_tag_index(remote='origin', allow_exit=False):
+    """Returns the TagIndex of a git remote, or None if it can't be listed
+    and allow_exit is True.
+
+    This only lists the remote refs, without fetching anything.
+    """
+    # remotes can have more refs than run() keeps lines: the output is
+    # parsed as it comes
+    cmd = 'git ls-remote --tags --heads %s' % remote
+    refs = {}
+    with span(cmd, 'command', command=cmd) as trace_args:
+        sub = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+        for line in sub.stdout:
+            line = line.split()
+            if len(line) != 2:
+                continue
+            sha, ref = line
+            for kind in ('refs/tags/', 'refs/heads/'):
+                if ref.startswith(kind):
+                    ref = ref[len(kind):]
+                    if ref.endswith('^{}'):
+                        # commit of an annotated tag
+                        ref = ref[:-len('^{}')]
+                    refs[ref] = sha
+        err = sub.stderr.read()
+        code = trace_args['exit_code'] = sub.wait()
+    if code != 0:
+        if not allow_exit:
+            print("%r failed with code %d" % (cmd, code))
+            print(err)
+            sys.exit(code)
+        return None
+    return TagIndex(refs)
+
+
+def has_new_remote_tags(remote='origin', prefix=TAG_PREFIX):
+    """Tells if the git remote has tags missing from the local repository.
+    """
+    remote = get_remote_tag_index(remote, allow_exit=True)
+    if remote is None:
+        return True
+    local = get_tag_index().refs
+    for tag in remote.refs:
+        if tag.startswith(prefix) and tag not in local:
+            return True
+    return False
+
+
+# files that, when changed, require a new setup.py develop
+_DEVELOP_FILES = ('setup.py', 'setup.cfg', '*-reqs.txt', 'requirements*.txt')
+_DEVELOP_FINGERPRINT = 'mopytools-develop.txt'
+
+
+def develop_fingerprint(python=PYTHON):
+    """Returns a hash of what setup.py develop depends on in the current
+    dir: the setup files, the requirements, the checked out revision and
+    the interpreter."""
+    fingerprint = hashlib.sha1()
+    fingerprint.update('%s\n%s\n' % (python, sys.version))
+    fingerprint.update('%s\n' % get_revision())
+    for pattern in _DEVELOP_FILES:
+        for filename in sorted(glob.glob(pattern)):
+            with open(filename, 'rb') as f:
+                fingerprint.update('%s\n%s\n' % (filename, f.read()))
+    return fingerprint.hexdigest()
+
+
+def _fingerprint_file(name=_DEVELOP_FINGERPRINT):
+    egg_info = sorted(glob.glob('*.egg-info'))
+    if not egg_info:
+        return None
+    return os.path.join(egg_info[0], name)
+
+
+def _read_fingerprint(name=_DEVELOP_FINGERPRINT):
+    path = _fingerprint_file(name)
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _write_fingerprint(fingerprint, name=_DEVELOP_FINGERPRINT):
+    path = _fingerprint_file(name)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(fingerprint)
+
+
+def develop(python=PYTHON, timeout=300, verbose=False, force=False):
+    """Runs setup.py develop in the current dir.
+
+    The run is skipped if the project was already developed with the same
+    fingerprint, unless force is True. The fingerprint is kept in the
+    egg-info directory.
+
+    Returns True if setup.py develop was run.
+    """
+    if not force and is_developed(python):
+        print('Nothing changed, skipping setup.py develop')
+        return False
+
+    fingerprint = develop_fingerprint(python)
+    run('%s setup.py develop' % python, timeout, verbose)
+    _write_fingerprint(fingerprint)
+    return True
+
+
+def is_developed(python=PYTHON):
+    """Tells if setup.py develop already ran in the current dir, with the
+    same fingerprint, and if the environment of python still has it.
+
+    The fingerprint is kept in the source tree, so it survives a
+    virtualenv recreated at the same path.
+    """
+    return (_read_fingerprint() == develop_fingerprint(python) and
+            is_installed(python=python))
+
+
+# python -> its site-packages
+_SITE_PACKAGES = {}
+
+
+def get_site_packages(python=PYTHON):
+    """Returns the site-packages directory of a python interpreter."""
+    if python not in _SITE_PACKAGES:
+        if python == sys.executable:
+            from distutils.sysconfig import get_python_lib
+            location = get_python_lib()
+        else:
+            code, out, err = run('%s -c "from distutils.sysconfig import '
+                                 'get_python_lib; print(get_python_lib())"'
+                                 % python)
+            location = out.strip()
+        _SITE_PACKAGES[python] = location
+    return _SITE_PACKAGES[python]
+
+
+def is_installed(location=None, python=PYTHON):
+    """Tells if the project in location, by default the current dir, is
+    developed in the environment of python: an egg-link or an
+    easy-install.pth entry points to it."""
+    location = os.path.realpath(location or os.getcwd())
+    site_packages = get_site_packages(python)
+    paths = glob.glob(os.path.join(site_packages, '*.egg-link'))
+    paths.append(os.path.join(site_packages, 'easy-install.pth'))
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith(('#', 'import')) and \
+                        os.path.realpath(line) == location:
+                    return True
+    return False
+
+
+_REQS_FINGERPRINT = 'mopytools-reqs.txt'
+
+
+def read_requirements(reqfile):
+    """Returns the requirement lines of a file, without comments."""
+    lines = []
+    with open(reqfile) as f:
+        for line in f.readlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            lines.append(line)
+    return lines
+
+
+def reqs_fingerprint(lines, index=None, extras=None, python=PYTHON):
+    """Returns a hash of a pip install of requirement lines."""
+    fingerprint = hashlib.sha1()
+    fingerprint.update('%s\n%s\n%s\n' % (python, index, extras))
+    fingerprint.update('\n'.join(lines))
+    return fingerprint.hexdigest()
+
+
+def missing_requirements(lines):
+    """Returns the requirement lines not satisfied by the distributions
+    installed for the running interpreter.
+
+    Lines holding pip options, URLs or editables can't be checked and are
+    always returned.
+    """
+    from pkg_resources import Requirement, WorkingSet, VersionConflict
+    working_set = WorkingSet()
+    missing = []
+    for line in lines:
+        if line.startswith('-') or '://' in line:
+            missing.append(line)
+            continue
+        try:
+            dist = working_set.find(Requirement.parse(line))
+        except (ValueError, VersionConflict):
+            dist = None
+        if dist is None:
+            missing.append(line)
+    return missing
+
+
+def requirements_to_install(reqfile, index, extras=None, python=PYTHON,
+                            force=False):
+    """Returns the requirement lines of reqfile, the ones install_requirements
+    would pass to pip, and the fingerprint of the requirements."""
+    lines = read_requirements(reqfile)
+    fingerprint = reqs_fingerprint(lines, index, extras, python)
+    installed = _read_fingerprint(_REQS_FINGERPRINT) == fingerprint
+    checkable = (not force and
+                 os.path.abspath(python) == os.path.abspath(sys.executable))
+
+    if checkable and (installed or not get_non_pinned(reqfile)):
+        install = missing_requirements(lines)
+    else:
+        install = lines
+    return lines, install, fingerprint
+
+
+def install_requirements(reqfile, index, extras=None, timeout=300,
+                         verbose=False, cache=None, python=PYTHON, pip=PIP,
+                         force=False, wheelhouse=None):
+    """Runs pip install -U on the requirements file, for what is missing.
+
+    pip is not run at all when all the requirements are satisfied by the
+    installed distributions, and only gets the missing lines otherwise.
+    Unpinned requirements are satisfied by any version, so they are only
+    trusted when the requirements file was already installed with the same
+    index and interpreter: its fingerprint is kept in the egg-info
+    directory. The check is done in-process, so it is skipped when python
+    is not the running interpreter, or when force is True.
+
+    With a wheelhouse, the pinned requirements are built into wheels kept
+    there, and installed from them without reaching the index.
+
+    Returns the list of lines that were passed to pip.
+    """
+    lines, install, fingerprint = requirements_to_install(reqfile, index,
+                                                          extras, python,
+                                                          force)
+    if not install:
+        print('All requirements are already satisfied, skipping pip')
+        _write_fingerprint(fingerprint, _REQS_FINGERPRINT)
+        return install
+
+    if install != lines:
+        print('Installing %d missing requirements out of %d'
+              % (len(install), len(lines)))
+
+    remaining = install
+    if wheelhouse is not None:
+        # pinned versions are installed from wheels, built once
+        pinned = [line for line in install
+                  if parse_requirement(line)[1] == '==']
+        if pinned:
+            house = get_wheelhouse(wheelhouse, python)
+            build_wheels(pinned, house, index, extras, timeout, verbose,
+                         cache, pip)
+            _pip_install(pinned, '--no-index --find-links %s' % house,
+                         timeout, verbose, pip)
+            remaining = [line for line in install if line not in pinned]
+
+    if remaining:
+        options = '-i %s' % index
+        if cache is not None:
+            options += ' --download-cache %s' % cache
+        if extras is not None:
+            options += ' --extra-index-url %s' % extras
+        _pip_install(remaining, options, timeout, verbose, pip,
+                     remaining == lines and reqfile or None)
+
+    _write_fingerprint(fingerprint, _REQS_FINGERPRINT)
+    return install
+
+
+def _pip_install(lines, options, timeout=300, verbose=False, pip=PIP,
+                 reqfile=None):
+    """Runs pip install -U on lines, through a temporary requirements file
+    unless reqfile already holds them."""
+    path = reqfile
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='-reqs.txt', dir='.')
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    try:
+        run('%s install %s -U -r %s' % (pip, options, path), timeout,
+            verbose)
+    finally:
+        if path != reqfile:
+            os.remove(path)
+
+
+_WHEEL_TAG = ('import sys, distutils.util; '
+              'print("cp%d%d-%s" % (sys.version_info[:2] + '
+              '(distutils.util.get_platform().replace("-", "_"),)))')
+
+
+def get_wheelhouse(root, python=PYTHON):
+    """Returns the wheels directory of the interpreter under root.
+
+    Wheels are kept per Python version and platform, so several
+    interpreters can share the same root.
+    """
+    code, tag, err = run("%s -c '%s'" % (python, _WHEEL_TAG))
+    house = os.path.join(root, tag.strip())
+    if not os.path.exists(house):
+        os.makedirs(house)
+    return house
+
+
+def _wheel_name(project):
+    return re.sub('[^A-Za-z0-9.]+', '_', project).lower()
+
+
+def has_wheel(house, project, version):
+    """Tells if a wheel of project at version is in the house."""
+    prefix = '%s-%s-' % (_wheel_name(project), version)
+    for filename in os.listdir(house):
+        if filename.lower().startswith(prefix) and filename.endswith('.whl'):
+            return True
+    return False
+
+
+def build_wheels(lines, house, index, extras=None, timeout=300,
+                 verbose=False, cache=None, pip=PIP):
+    """Builds the wheels of the pinned lines that are not yet in the house.
+
+    Returns the lines that were built.
+    """
+    build = []
+    for line in lines:
+        project, token, version = parse_requirement(line)
+        if not has_wheel(house, project, version):
+            build.append(line)
+    if not build:
+        return build
+
+    print('Building %d wheels in %s' % (len(build), house))
+    cmd = '%s wheel --wheel-dir %s -i %s' % (pip, house, index)
+    if cache is not None:
+        cmd += ' --download-cache %s' % cache
+    if extras is not None:
+        cmd += ' --extra-index-url %s' % extras
+    cmd += ' ' + ' '.join(['"%s"' % line for line in build])
+    run(cmd, timeout, verbose)
+    return build
+
+
+def checkout_cmd(tag=None, git=True, channel='prod', force=False):
+    """Returns the command checking out tag, or the current revision."""
     if force and channel != 'dev':
-        if is_git():
+        if git:
             cmd = 'git checkout --force'
         else:
             cmd = 'hg up -C'
 
     elif channel != 'dev':
-        if is_git():
+        if git:
             cmd = 'git checkout'
         else:
             cmd = 'hg up -c'
     else:
-        if is_git():
+        if git:
             cmd = 'git checkout'
         else:
             cmd = 'hg up'
 
+    if tag is None:
+        return cmd
+    if git:
+        return '%s "%s"' % (cmd, tag)
+    return '%s -r "%s"' % (cmd, tag)
+
+
+def update_cmd(project=None, channel="prod", specific_tag=False,
+               force=False):
     if not specific_tag:
-        if is_git():
-            return '%s "%s"' % (cmd, get_channel_tag(channel))
-        else:
-            return '%s -r "%s"' % (cmd, get_channel_tag(channel))
+        return checkout_cmd(get_channel_tag(channel), is_git(), channel,
+                            force)
 
     # looking for an environ with a specific tag or rev
     if project is not None:
@@ -280,13 +1188,9 @@ def update_cmd(project=None, channel="prod", specific_tag=False,
             if not tag_exists(rev):
                 print('Unknown tag or revision: %s' % rev)
                 sys.exit(1)
+            return checkout_cmd(rev, is_git(), channel, force)
 
-            if is_git():
-                return '%s "%s"' % (cmd, rev)
-            else:
-                return '%s -r "%s"' % (cmd, rev)
-
-    return cmd
+    return checkout_cmd(None, is_git(), channel, force)
 
 
 _LEVEL = -1
@@ -305,7 +1209,10 @@ def step(text):
             sys.stdout.write(msg)
             sys.stdout.flush()
             try:
-                res = func(*args, **kw)
+                start = time.time()
+                with span(text % kw, 'step'):
+                    res = func(*args, **kw)
+                record_duration(text % kw, time.time() - start)
                 pad = 100 - (len(step) + msg_len)
                 msg = ('%s%' + str(pad) + 's')
 
@@ -334,55 +1241,190 @@ def is_meta_project():
 
 
 def get_spec_file():
-    for file_ in os.listdir(os.getcwd()):
-        if os.path.splitext(file_)[-1] == '.spec':
-            return os.path.join(os.getcwd(), file_)
-    return None
+    return get_metadata().spec_file
+
 
+_NAME = re.compile('^Name: *(.*?) *$', re.M)
+_VERSION = re.compile('^Version: *(.*?) *$', re.M)
 
-_V = NormalizedVersion
+
+class ProjectMetadata(object):
+    """Name, version, spec file and repository URL of the project located
+    in a directory.
+
+    Each one is read once, when first used. The distribution name and
+    version come from PKG-INFO, the egg-info directory or setup.cfg, and
+    setup.py is only run when none of them has it.
+
+    setuptools writes the safe_name of the project in the egg-info: as
+    "Mozsvc_Foo" becomes "Mozsvc-foo" there, a name with a dash is not
+    taken from the egg-info, so that RPM names don't change.
+    """
+    def __init__(self, location):
+        self.location = location
+        self.files = os.listdir(location)
+        self._spec = _MISSING
+        self._pkg_info = _MISSING
+        self._egg_info = False
+        self._name = self._version = None
+
+    def _path(self, *path):
+        return os.path.join(self.location, *path)
+
+    @property
+    def spec_file(self):
+        for file_ in sorted(self.files):
+            if os.path.splitext(file_)[-1] == '.spec':
+                return self._path(file_)
+        return None
+
+    @property
+    def spec(self):
+        """Content of the spec file, or None."""
+        if self._spec is _MISSING:
+            self._spec = None
+            if self.spec_file is not None:
+                with open(self.spec_file) as f:
+                    self._spec = f.read()
+        return self._spec
+
+    @property
+    def pkg_info(self):
+        """Content of PKG-INFO, from a sdist or a egg-info, or None."""
+        if self._pkg_info is _MISSING:
+            self._pkg_info = None
+            paths = [self._path('PKG-INFO')]
+            paths += [self._path(file_, 'PKG-INFO')
+                      for file_ in sorted(self.files)
+                      if file_.endswith('.egg-info')]
+            for path in paths:
+                if os.path.exists(path):
+                    with open(path) as f:
+                        self._pkg_info = f.read()
+                    self._egg_info = path != paths[0]
+                    break
+        return self._pkg_info
+
+    def _read(self, field, regex):
+        if self.pkg_info is not None:
+            found = regex.findall(self.pkg_info)
+            if found and not (field == 'name' and self._egg_info and
+                              '-' in found[0]):
+                return found[0]
+
+        setup_cfg = self._path('setup.cfg')
+        if 'setup.cfg' in self.files:
+            reader = ConfigParser()
+            reader.read(setup_cfg)
+            if reader.has_option('metadata', field):
+                return reader.get('metadata', field).strip()
+
+        if 'setup.py' not in self.files:
+            return None
+
+        # last resort
+        code, out, err = run('cd %s && %s setup.py --%s'
+                             % (pipes.quote(self.location),
+                                pipes.quote(sys.executable), field))
+        lines = [line for line in out.split('\n') if line.strip() != '']
+        return lines and lines[-1].strip() or None
+
+    @property
+    def name(self):
+        """Distribution name."""
+        if self._name is None:
+            self._name = self._read('name', _NAME)
+        return self._name
+
+    @property
+    def version(self):
+        """Distribution version."""
+        if self._version is None:
+            self._version = self._read('version', _VERSION)
+        return self._version
+
+    @property
+    def url(self):
+        """Repository URL, from the spec file or the hg paths."""
+        if self.spec is not None:
+            url = _URL.findall(self.spec)
+            if len(url) == 1:
+                return url[0]
+
+        hgrc = self._path('.hg', 'hgrc')
+        if os.path.exists(hgrc):
+            reader = ConfigParser()
+            reader.read(hgrc)
+            if reader.has_option('paths', 'default'):
+                return reader.get('paths', 'default')
+        return None
+
+
+# (location, revision, mtime, links) -> ProjectMetadata
+_METADATA = {}
+
+
+def get_metadata(location=None):
+    """Returns the ProjectMetadata of the project located in a directory,
+    by default the current one.
+
+    The metadata is kept for the revision of the project, as long as no
+    file is added or removed at its root.
+    """
+    location = os.path.abspath(location or os.getcwd())
+    old_dir = os.getcwd()
+    os.chdir(location)
+    try:
+        stat = os.stat(location)
+        key = location, get_revision(), stat.st_mtime, stat.st_nlink
+    finally:
+        os.chdir(old_dir)
+    if key not in _METADATA:
+        _METADATA[key] = ProjectMetadata(location)
+    return _METADATA[key]
 
 
 def _match(version, token, other):
     token = token.strip()
-    try:
-        if token == '==':
-            return version == other
-        elif token == '>=':
-            return _V(version) >= _V(other)
-        elif token == '>':
-            return _V(version) > _V(other)
-        elif token == '<=':
-            return _V(version) <= _V(other)
-        elif token == '<':
-            return _V(version) < _V(other)
-        elif token == '!=':
-            return _V(version) != _V(other)
-    except IrrationalVersionError:
+    if token == '==':
+        return version == other
+
+    version, other = normalized_version(version), normalized_version(other)
+    if version is None or other is None:
         return False
+    if token == '>=':
+        return version >= other
+    elif token == '>':
+        return version > other
+    elif token == '<=':
+        return version <= other
+    elif token == '<':
+        return version < other
+    elif token == '!=':
+        return version != other
     raise NotImplementedError(token)
 
 
-def _vsort(version1, version2):
-    if _V(version1) > _V(version2):
-        return -1
-    elif _V(version1) < _V(version2):
-        return 1
-    return 0
+def _latest_first(versions):
+    """Sorts the version strings, latest first."""
+    versions.sort(key=normalized_version, reverse=True)
 
 
 def _best_release(project_name, version=None, token='==',
                   index_url=DEFAULT_SIMPLE_INDEX_URL):
-    c = Crawler(index_url=index_url, prefer_final=True)
-    project = c.get_releases(project_name)
-    versions = project.get_versions()
+    versions = [ver for ver in
+                get_index_cache().get_versions(project_name, index_url)
+                if normalized_version(ver) is not None]
 
     if version is None:
-        versions.sort(_vsort)
-        return versions[0]
+        # the latest final release, if any
+        _latest_first(versions)
+        finals = [ver for ver in versions
+                  if normalized_version(ver).is_final]
+        return (finals or versions)[0]
     else:
         selected = []
-        for existing_ver in project.get_versions():
+        for existing_ver in versions:
             if _match(existing_ver, token, version):
                 selected.append(existing_ver)
 
@@ -390,46 +1432,72 @@ def _best_release(project_name, version=None, token='==',
             print 'Unknown version'
             return None
 
-        selected.sort(_vsort)
+        _latest_first(selected)
         return selected[0]
 
 
-def split_version(line):
-    tokens = ['==', '>=', '<=', '>', '<', '!=']
-    for token in tokens:
+_TOKENS = ['==', '>=', '<=', '>', '<', '!=']
+
+
+def parse_requirement(line):
+    """Splits a requirement line into a (project, token, version) tuple.
+
+    token and version are None if the line has no version specifier.
+    """
+    for token in _TOKENS:
         if token in line:
-            if token != '==':
-                # we need to grab a list of versions from
-                # PyPI and decide which one works
-                app, version = line.split(token, 1)
-                app, version = app.strip(), version.strip()
-                version = _best_release(app, version, token.strip())
-            else:
-                app, version = line.split(token, 1)
+            app, version = line.split(token, 1)
+            return app.strip(), token, version.strip()
+    return line.strip(), None, None
 
-            return app.strip(), version.strip()
-    return line.strip(), None
+
+def split_version(line, index_url=DEFAULT_SIMPLE_INDEX_URL):
+    app, token, version = parse_requirement(line)
+    if token not in (None, '=='):
+        # we need to grab a list of versions from
+        # PyPI and decide which one works
+        version = _best_release(app, version, token, index_url)
+    return app, version
+
+
+def resolve_requirements(lines, index_url=DEFAULT_SIMPLE_INDEX_URL, jobs=8):
+    """Returns the (project, version) build plan of requirement lines.
+
+    Pinned lines are kept as is. Ranged and unpinned lines are all
+    resolved against the index at the same time, using up to `jobs`
+    threads that each keep their connections to the index alive.
+    """
+    reqs = [parse_requirement(line) for line in lines]
+    projects = []
+    for app, token, version in reqs:
+        if token != '==' and app not in projects:
+            projects.append(app)
+
+    # fetching the versions of each project once, all at the same time
+    if projects:
+        cache = get_index_cache()
+        pool = ThreadPool(max(1, min(jobs, len(projects))))
+        try:
+            pool.map(lambda app: cache.get_versions(app, index_url),
+                     projects)
+        finally:
+            pool.terminate()
+
+    plan = []
+    for app, token, version in reqs:
+        if token != '==':
+            version = _best_release(app, version, token or '==', index_url)
+        plan.append((app, version))
+    return plan
 
 
 def get_project_name():
     if is_meta_project():
         return None
 
-    spec_file = get_spec_file()
-    if spec_file is not None:
-        with open(spec_file) as f:
-            data = f.read()
-            name = _URL.findall(data)
-            if len(name) == 1:
-                return name[0].split('/')[-1]
-
-    hgrc = os.path.join('.hg', 'hgrc')
-    if os.path.exists(hgrc):
-        reader = ConfigParser()
-        reader.read(hgrc)
-        if reader.has_option('paths', 'default'):
-            repo_url = reader.get('paths', 'default')
-            return repo_url.split('/')[-1]
+    url = get_metadata().url
+    if url is not None:
+        return url.split('/')[-1]
 
     raise IOError('Unable to find the project name.')
 
@@ -503,6 +1571,11 @@ def get_options(extra_options=None):
                       action="store_true", default=False,
                       help="Forces update")
 
+    parser.add_option("--reinstall", dest="reinstall",
+                      action="store_true", default=False,
+                      help="Runs setup.py develop and pip even when "
+                           "nothing changed")
+
     parser.add_option("-v", "--verbose", dest="verbose",
                       action="store_true", default=False,
                       help="Verbose mode")
@@ -515,11 +1588,64 @@ def get_options(extra_options=None):
                       help="Download cache",
                       default=None)
 
+    parser.add_option("--index-cache", dest="index_cache",
+                      help="Directory where the index pages are cached",
+                      default=None)
+
+    parser.add_option("--index-cache-ttl", dest="index_cache_ttl",
+                      help="Seconds before a cached index page is checked "
+                           "again",
+                      default=3600, type="int")
+
+    parser.add_option("--offline", dest="offline",
+                      action="store_true", default=False,
+                      help="Only use the cached index pages")
+
+    parser.add_option("--log-file", dest="log_file",
+                      help="File where the output of all commands is logged",
+                      default=None)
+
+    parser.add_option("--trace", dest="trace",
+                      help="Save a timeline of the build in this file, "
+                           "in the Chrome trace-event format",
+                      default=None)
+
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      help="Number of parallel jobs",
+                      default=1, type="int")
+
+    parser.add_option("--mirror-dir", dest="mirror_dir",
+                      help="Directory of bare mirrors shared by the "
+                           "checkouts of the internal dependencies",
+                      default=None)
+
+    parser.add_option("--shallow", dest="shallow",
+                      help="Only fetch the target tag of the git "
+                           "dependencies",
+                      action="store_true", default=False)
+
+    parser.add_option("--wheelhouse", dest="wheelhouse",
+                      help="Build the pinned external deps into wheels "
+                           "kept in this directory, and install them "
+                           "from there",
+                      default=None)
+
+    parser.add_option("--plan", dest="plan",
+                      help="Print what the build would do, with the "
+                           "durations of the previous runs, and exit",
+                      action="store_true", default=False)
+
     for optargs, optkw in extra_options:
         parser.add_option(*optargs, **optkw)
 
     options, args = parser.parse_args()
 
+    if options.mirror_dir is not None:
+        options.mirror_dir = os.path.abspath(options.mirror_dir)
+
+    if options.wheelhouse is not None:
+        options.wheelhouse = os.path.abspath(options.wheelhouse)
+
     if len(args) > 1:
         print('Wrong number of arguments.')
         parser.print_usage()
@@ -528,6 +1654,16 @@ def get_options(extra_options=None):
     # set pypi location
     setup_pypi(options.index, options.extras, options.strict)
 
+    if options.log_file is not None:
+        set_log_file(os.path.abspath(options.log_file))
+
+    if options.trace is not None:
+        start_tracing(os.path.abspath(options.trace))
+
+    # set the index pages cache
+    set_index_cache(IndexCache(options.index_cache, options.index_cache_ttl,
+                               options.offline))
+
     return options, args
 
 
@@ -565,6 +1701,7 @@ def get_non_pinned(reqfile):
 
     Look for XXX==XXX patterns
     """
+    from pip.req import parse_requirements
     res = []
     for req in parse_requirements(reqfile, options=Options()):
         if list(req.absolute_versions) == []: